@@ -0,0 +1,485 @@
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import data, sshserver
+from benchmarks.fakebot import FakeBot
+from benchmarks.run import peak_rss_mb
+from functions import instrumentation
+from functions.instrumentation import quantiles
+
+USER_ID = 1
+METRICS = [['loss'], ['accuracy'], ['lr']]
+MONITOR_CYCLES = 20
+APPEND_ROWS = 1000
+RUN_FILES = 20
+WATCH_EVENTS = 10
+WATCH_IDLE = 10  # Seconds without changes during which the stat calls are counted
+RENDERS = 20
+RENDER_BACKENDS = ('plotly', 'matplotlib')
+RENDER_GROUPS = (1, 4, 9)  # Metric groups, one subplot each
+SCHEMA_READS = 20
+QUEUE_READS = 20
+QUEUE_CALLERS = 50
+SUBMIT_SCRIPTS = 50
+CANCEL_RANGE = '1000-1499'
+STORE_WRITES = 10000
+REPEATS = 3  # Throughput cases keep their best run
+STARTUP_MODULES = ['functions.instrumentation', 'functions.fsm_storage', 'functions.webhook', 'functions.handlers']
+
+
+def latency(name, durations):
+    p50, p95, p99 = quantiles(durations)
+    return {f'{name}_p50_ms': p50 * 1000, f'{name}_p95_ms': p95 * 1000, f'{name}_p99_ms': p99 * 1000}
+
+
+def span_p50(name):
+    stat = instrumentation.spans.get(name)
+    return quantiles(stat['recent'])[0] * 1000 if stat else 0.0
+
+
+def throughput(size, seconds):
+    return size / 2 ** 20 / seconds if seconds else 0.0
+
+
+def worker_pid():
+    time.sleep(0.2)
+    return os.getpid()
+
+
+def start_render_workers():
+    # Does what rendering.warm_up does after startup and returns once every render
+    # process has finished its own warm-up, so no timed cycle pays for either
+    from config import RENDER_WORKERS
+    from functions import rendering
+    importlib.import_module('functions.plotting')
+    pool = rendering.get_render_pool()
+    pids = set()
+    while len(pids) < RENDER_WORKERS:
+        pids.update(future.result() for future in [pool.submit(worker_pid) for _ in range(RENDER_WORKERS)])
+
+
+def ssh_session(data_dir):
+    bin_dir = data.fake_slurm(os.path.join(data_dir, 'bin'))
+    return bin_dir, sshserver.connect(sshserver.serve(bin_dir))
+
+
+STARTUP_SCRIPT = '''
+import importlib, json, sys, time
+result = {}
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    module_start = time.perf_counter()
+    importlib.import_module(module)
+    result['import_' + module.rsplit('.', 1)[-1] + '_s'] = time.perf_counter() - module_start
+result['import_s'] = time.perf_counter() - start
+result['import_rss_mb'] = int([line for line in open('/proc/self/status') if line.startswith('VmHWM:')][0].split()[1]) / 1024
+result['heavy_modules_loaded'] = sorted(name for name in ('pandas', 'plotly', 'matplotlib') if name in sys.modules)
+print(json.dumps(result))
+'''
+
+
+def case_startup(context):
+    # A fresh interpreter, since this process has already imported the benchmark helpers
+    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, *STARTUP_MODULES], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def legacy_read_log(file_path):
+    # The per-row parser read_data used for logs before the columnar one, kept as the reference
+    import pandas as pd
+    data = []
+    with open(file_path, 'r') as file:
+        for line in file:
+            elements = line.strip().split()
+            epoch = int(elements[1])
+            values = elements[2:]
+            row = {'Epoch': epoch}
+            for i in range(0, len(values), 2):
+                row[values[i]] = float(values[i + 1])
+            data.append(row)
+    df = pd.DataFrame(data)
+    if not df.empty:
+        df.set_index('Epoch', inplace=True)
+    return df
+
+
+def best_time(function, path):
+    seconds = float('inf')
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function(path)
+        seconds = min(seconds, time.perf_counter() - start)
+    return seconds, result
+
+
+def parse_case(kind):
+    def case_parse(context):
+        from functions import plotting
+        path = data.metrics_file(context['data_dir'], kind, context['size'])
+        size = os.path.getsize(path)
+        seconds, df = best_time(plotting.read_data, path)
+        result = {'parse_s': seconds, 'parse_mb_per_s': throughput(size, seconds), 'rows': len(df)}
+        if kind == 'log':
+            # Taken before the reference runs, whose row dicts would set the peak of the process
+            result['parse_peak_rss_mb'] = peak_rss_mb()
+            legacy_seconds, _ = best_time(legacy_read_log, path)
+            result.update({'legacy_parse_s': legacy_seconds, 'legacy_parse_mb_per_s': throughput(size, legacy_seconds),
+                           'speedup': legacy_seconds / seconds if seconds else 0.0})
+        return result
+    return case_parse
+
+
+def case_plot(context):
+    # read_data -> downsample -> plot_data -> PNG in this process, one timing per stage
+    from functions import plotting
+    from plotly.io import to_image
+    path = data.metrics_file(context['data_dir'], 'csv', context['size'])
+    start = time.perf_counter()
+    df = plotting.read_data(path)
+    read_done = time.perf_counter()
+    reduced = plotting.downsample(df, METRICS)
+    downsample_done = time.perf_counter()
+    figure = plotting.plot_data(reduced, METRICS)
+    figure_done = time.perf_counter()
+    to_image(figure, format='png', scale=1)
+    png_done = time.perf_counter()
+    return {'read_s': read_done - start, 'downsample_s': downsample_done - read_done,
+            'figure_s': figure_done - downsample_done, 'png_s': png_done - figure_done,
+            'total_s': png_done - start}
+
+
+async def render_bench(backend, groups):
+    import numpy as np
+    import pandas as pd
+    from functions import rendering
+    start_render_workers()
+    rng = np.random.default_rng(0)
+    metrics = [[f'metric{i}'] for i in range(groups)]
+    durations = []
+    for _ in range(RENDERS):
+        # Distinct data every time, so the cache never answers
+        df = pd.DataFrame({group[0]: rng.random(10000) for group in metrics})
+        start = time.perf_counter()
+        await rendering.render_plot(df, metrics, backend)
+        durations.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await rendering.render_plot(df, metrics, backend)
+    result = latency('render', durations)
+    result['render_cached_ms'] = (time.perf_counter() - start) * 1000
+    rendering.reset_render_pool()
+    return result
+
+
+def render_case(backend, groups):
+    def case_render(context):
+        return asyncio.run(render_bench(backend, groups))
+    return case_render
+
+
+async def monitor_case(context, remote, kind='csv'):
+    from functions import monitor, rendering, send_queue
+    from functions.async_ssh import run_blocking
+    work_dir = tempfile.mkdtemp(dir=context['data_dir'])
+    path = os.path.join(work_dir, f'metrics.{kind}')
+    shutil.copyfile(data.metrics_file(context['data_dir'], kind, context['size']), path)
+    bin_dir, ssh_client = ssh_session(context['data_dir'])
+    bot = FakeBot()
+    task = monitor.MonitorTask(USER_ID, path, METRICS, remote=remote)
+    start_render_workers()
+    try:
+        async def cycle():
+            sftp, results = await run_blocking(monitor.stat_files, USER_ID, ssh_client, [path])
+            start = time.perf_counter()
+            await monitor.monitor_file(task, sftp, results[path], bot, ssh_client)
+            return time.perf_counter() - start
+
+        result = {'initial_load_s': await cycle()}
+        step = 10 ** 9
+        durations = []
+        for _ in range(MONITOR_CYCLES):
+            data.append_rows(path, kind, APPEND_ROWS, step)
+            step += APPEND_ROWS
+            durations.append(await cycle())
+        await asyncio.sleep(0)
+        result.update(latency('cycle', durations))
+        for name in ('monitor_download', 'monitor_parse', 'monitor_remote_aggregation', 'monitor_render',
+                     'telegram_send'):
+            if name in instrumentation.spans:
+                result[f'{name}_p50_ms'] = span_p50(name)
+        result['plots_sent'] = bot.count('send_photo') + bot.count('edit_message_media')
+        result['plots_queued'] = len(send_queue.pending)
+        result['history_mb'] = task.memory() / 2 ** 20
+        return result
+    finally:
+        task.cancelled = True
+        monitor.close_sftp(USER_ID)
+        ssh_client.close()
+        rendering.reset_render_pool()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def case_monitor(context):
+    return asyncio.run(monitor_case(context, remote=False))
+
+
+def case_monitor_remote(context):
+    return asyncio.run(monitor_case(context, remote=True))
+
+
+def case_monitor_jsonl(context):
+    return asyncio.run(monitor_case(context, remote=False, kind='jsonl'))
+
+
+async def monitor_runs_case(context):
+    # A sweep directory watched with one glob task; every cycle one run file grows
+    from functions import monitor, rendering
+    from functions.async_ssh import run_blocking
+    work_dir = tempfile.mkdtemp(dir=context['data_dir'])
+    for i in range(RUN_FILES):
+        data.write_metrics_file(os.path.join(work_dir, f'run_{i:02d}.csv'), 'csv', context['size'] // RUN_FILES, seed=i)
+    bin_dir, ssh_client = ssh_session(context['data_dir'])
+    bot = FakeBot()
+    task = monitor.MonitorTask(USER_ID, os.path.join(work_dir, '*.csv'), METRICS)
+    start_render_workers()
+    try:
+        async def cycle():
+            start = time.perf_counter()
+            sftp, results = await run_blocking(monitor.stat_files, USER_ID, ssh_client, [], [work_dir])
+            await monitor.monitor_runs(task, sftp, results[work_dir], bot, ssh_client)
+            return time.perf_counter() - start
+
+        result = {'initial_load_s': await cycle()}
+        read_before = instrumentation.counters.get('monitor_bytes', 0)
+        durations = []
+        for i in range(MONITOR_CYCLES):
+            data.append_rows(os.path.join(work_dir, f'run_{i % RUN_FILES:02d}.csv'), 'csv', APPEND_ROWS, 10 ** 9 + i)
+            durations.append(await cycle())
+        result.update(latency('cycle', durations))
+        result['cycle_read_bytes'] = (instrumentation.counters.get('monitor_bytes', 0) - read_before) // MONITOR_CYCLES
+        result['monitor_render_p50_ms'] = span_p50('monitor_render')
+        result['runs'] = len(task.runs)
+        result['history_mb'] = task.memory() / 2 ** 20
+        return result
+    finally:
+        task.cancelled = True
+        monitor.close_sftp(USER_ID)
+        ssh_client.close()
+        rendering.reset_render_pool()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def case_monitor_runs(context):
+    return asyncio.run(monitor_runs_case(context))
+
+
+async def wait_for(condition, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("Condition not met in time")
+        await asyncio.sleep(0.02)
+
+
+async def monitor_watch_case(context):
+    # The whole scheduler with the file watcher: time from an append to the plot
+    # reaching the bot, and the stat calls made while the file stays the same
+    from functions import monitor, rendering, save_load_data, file_watcher
+    work_dir = tempfile.mkdtemp(dir=context['data_dir'])
+    save_load_data.open_store(os.path.join(work_dir, 'bench.db'))
+    path = os.path.join(work_dir, 'metrics.csv')
+    shutil.copyfile(data.metrics_file(context['data_dir'], 'csv', context['size']), path)
+    bin_dir, ssh_client = ssh_session(context['data_dir'])
+    bot = FakeBot()
+    start_render_workers()
+    task = monitor.start_monitoring(USER_ID, path, bot, {USER_ID: ssh_client}, METRICS)
+
+    def plots():
+        return bot.count('send_photo') + bot.count('edit_message_media')
+
+    try:
+        await wait_for(lambda: USER_ID in file_watcher.watchers and file_watcher.watchers[USER_ID].established
+                       and plots())
+        step = 10 ** 9
+        durations = []
+        for _ in range(WATCH_EVENTS):
+            sent = plots()
+            start = time.perf_counter()
+            data.append_rows(path, 'csv', APPEND_ROWS, step)
+            step += APPEND_ROWS
+            await wait_for(lambda: plots() > sent)
+            durations.append(time.perf_counter() - start)
+        result = latency('change_to_plot', durations)
+        stats = instrumentation.spans['monitor_stat']['count']
+        await asyncio.sleep(WATCH_IDLE)
+        result['idle_stat_calls'] = instrumentation.spans['monitor_stat']['count'] - stats
+        result['watch_events'] = instrumentation.counters.get('monitor_watch_events', 0)
+        result['watched'] = task.watched
+        return result
+    finally:
+        monitor.stop_monitoring(USER_ID)
+        monitor.scheduler_task.cancel()
+        await save_load_data.close_store()
+        ssh_client.close()
+        rendering.reset_render_pool()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def case_monitor_watch(context):
+    return asyncio.run(monitor_watch_case(context))
+
+
+async def metrics_case(context):
+    from functions import metrics, monitor
+    path = data.metrics_file(context['data_dir'], 'csv', context['size'])
+    bin_dir, ssh_client = ssh_session(context['data_dir'])
+    ssh_clients = {USER_ID: ssh_client}
+    try:
+        durations = []
+        for _ in range(SCHEMA_READS):
+            metrics.schema_cache.clear()
+            start = time.perf_counter()
+            await metrics.get_metrics(USER_ID, path, None, ssh_clients)
+            durations.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await metrics.get_metrics(USER_ID, path, None, ssh_clients)
+        result = latency('get_metrics', durations)
+        result['get_metrics_cached_ms'] = (time.perf_counter() - start) * 1000
+        return result
+    finally:
+        monitor.close_sftp(USER_ID)
+        ssh_client.close()
+
+
+def case_get_metrics(context):
+    return asyncio.run(metrics_case(context))
+
+
+async def transfer_case(context, compression):
+    from functions import file_handling
+    file_handling.TRANSFER_COMPRESSION = compression
+    source = data.metrics_file(context['data_dir'], 'csv', context['size'])
+    size = os.path.getsize(source)
+    work_dir = tempfile.mkdtemp(dir=context['data_dir'])
+    bin_dir, ssh_client = ssh_session(context['data_dir'])
+    remote_path = os.path.join(work_dir, 'remote.csv')
+    local_path = os.path.join(work_dir, 'local.csv')
+    upload_seconds = download_seconds = float('inf')
+    try:
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            response = await file_handling.upload_file(ssh_client, source, remote_path)
+            upload_seconds = min(upload_seconds, time.perf_counter() - start)
+            if os.path.getsize(remote_path) != size:
+                raise RuntimeError(f"Upload failed: {response}")
+            start = time.perf_counter()
+            response = await file_handling.download_file(ssh_client, remote_path, local_path)
+            download_seconds = min(download_seconds, time.perf_counter() - start)
+            if os.path.getsize(local_path) != size:
+                raise RuntimeError(f"Download failed: {response}")
+            os.remove(remote_path)
+            os.remove(local_path)
+        return {'upload_s': upload_seconds, 'upload_mb_per_s': throughput(size, upload_seconds),
+                'download_s': download_seconds, 'download_mb_per_s': throughput(size, download_seconds)}
+    finally:
+        ssh_client.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def case_transfer_sftp(context):
+    return asyncio.run(transfer_case(context, compression=False))
+
+
+def case_transfer_gzip(context):
+    return asyncio.run(transfer_case(context, compression=True))
+
+
+async def scheduler_case(context):
+    from functions import scheduler_interface
+    bin_dir, ssh_client = ssh_session(context['data_dir'])
+    try:
+        durations = []
+        for _ in range(QUEUE_READS):
+            scheduler_interface.queue_snapshots.clear()
+            start = time.perf_counter()
+            await scheduler_interface.show_queue(ssh_client, {'state': 'RUNNING'})
+            durations.append(time.perf_counter() - start)
+        result = latency('show_queue', durations)
+
+        # Concurrent callers share one squeue run
+        scheduler_interface.queue_snapshots.clear()
+        calls = data.squeue_calls(bin_dir)
+        start = time.perf_counter()
+        await asyncio.gather(*(scheduler_interface.show_queue(ssh_client) for _ in range(QUEUE_CALLERS)))
+        result['show_queue_concurrent_s'] = time.perf_counter() - start
+        result['squeue_runs'] = data.squeue_calls(bin_dir) - calls
+
+        pattern = data.job_scripts(os.path.join(context['data_dir'], 'jobs'), SUBMIT_SCRIPTS)
+        start = time.perf_counter()
+        text, job_ids = await scheduler_interface.submit_job(ssh_client, pattern)
+        result['submit_s'] = time.perf_counter() - start
+        if len(job_ids) != SUBMIT_SCRIPTS:
+            raise RuntimeError(f"Submitted {len(job_ids)} of {SUBMIT_SCRIPTS} jobs: {text}")
+
+        start = time.perf_counter()
+        await scheduler_interface.cancel_job(ssh_client, CANCEL_RANGE)
+        result['cancel_s'] = time.perf_counter() - start
+        return result
+    finally:
+        ssh_client.close()
+
+
+def case_scheduler(context):
+    return asyncio.run(scheduler_case(context))
+
+
+async def store_case(context):
+    from functions import save_load_data
+    work_dir = tempfile.mkdtemp(dir=context['data_dir'])
+    save_load_data.open_store(os.path.join(work_dir, 'bench.db'))
+    try:
+        start = time.perf_counter()
+        for i in range(STORE_WRITES):
+            save_load_data.save_connection_details(i % 1000, 'cluster.example', f'user{i}', 22)
+            save_load_data.save_monitoring(i, i % 1000, f'/scratch/run{i}/metrics.csv', METRICS, 30)
+        queued = time.perf_counter() - start
+        await save_load_data.flush()
+        seconds = time.perf_counter() - start
+        return {'store_queue_s': queued, 'store_s': seconds, 'store_writes_per_s': 2 * STORE_WRITES / seconds}
+    finally:
+        await save_load_data.close_store()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def case_store(context):
+    return asyncio.run(store_case(context))
+
+
+# name -> (function, whether it runs once per file size)
+CASES = {
+    'startup': (case_startup, False),
+    'parse_csv': (parse_case('csv'), True),
+    'parse_json': (parse_case('json'), True),
+    'parse_jsonl': (parse_case('jsonl'), True),
+    'parse_log': (parse_case('log'), True),
+    'plot': (case_plot, True),
+    **{f'render_{backend}_{groups}': (render_case(backend, groups), False)
+       for backend in RENDER_BACKENDS for groups in RENDER_GROUPS},
+    'monitor': (case_monitor, True),
+    'monitor_remote': (case_monitor_remote, True),
+    'monitor_jsonl': (case_monitor_jsonl, True),
+    'monitor_runs': (case_monitor_runs, True),
+    'monitor_watch': (case_monitor_watch, True),
+    'get_metrics': (case_get_metrics, True),
+    'transfer_sftp': (case_transfer_sftp, True),
+    'transfer_gzip': (case_transfer_gzip, True),
+    'scheduler': (case_scheduler, False),
+    'store': (case_store, False),
+}
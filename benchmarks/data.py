@@ -0,0 +1,129 @@
+import json
+import os
+import re
+import stat
+
+import numpy as np
+
+BLOCK_ROWS = 100000
+UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+KINDS = ['csv', 'json', 'jsonl', 'log']
+METRIC_NAMES = ['loss', 'accuracy', 'lr']
+
+
+def parse_size(text):
+    match = re.fullmatch(r'(\d+)([KMG]?)B?', text.upper())
+    if match is None:
+        raise ValueError(f"Bad size: {text}")
+    return int(match.group(1)) * UNITS.get(match.group(2), 1)
+
+
+def metric_block(rng, start, rows):
+    steps = np.arange(start, start + rows)
+    loss = 2.0 / np.sqrt(steps + 1) + rng.random(rows) * 0.05
+    accuracy = 1 - loss / 3
+    lr = 1e-3 * 0.999 ** (steps / 1000)
+    return steps, loss, accuracy, lr
+
+
+def format_rows(kind, steps, loss, accuracy, lr):
+    if kind == 'csv':
+        return ''.join(f"{s},{a:.6f},{b:.6f},{c:.6e}\n" for s, a, b, c in zip(steps, loss, accuracy, lr))
+    if kind == 'log':
+        return ''.join(f"Epoch {s} loss {a:.6f} accuracy {b:.6f} lr {c:.6e}\n"
+                       for s, a, b, c in zip(steps, loss, accuracy, lr))
+    separator = ',' if kind == 'json' else ''
+    return ''.join(f'{{"step": {s}, "loss": {a:.6f}, "accuracy": {b:.6f}, "lr": {c:.6e}}}{separator}\n'
+                   for s, a, b, c in zip(steps, loss, accuracy, lr))
+
+
+def write_metrics_file(path, kind, size, start=0, seed=0):
+    # Appends rows until the file reaches `size` bytes. JSON files are an array of records,
+    # jsonl files one record per line.
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as file:
+        if kind == 'csv':
+            file.write('step,' + ','.join(METRIC_NAMES) + '\n')
+        elif kind == 'json':
+            file.write('[\n')
+        written = file.tell()
+        step = start
+        while written < size:
+            text = format_rows(kind, *metric_block(rng, step, BLOCK_ROWS))
+            if written + len(text) > size:
+                text = text[:text.rfind('\n', 0, max(size - written, 1)) + 1] or text[:text.find('\n') + 1]
+            file.write(text)
+            written += len(text)
+            step += BLOCK_ROWS
+        if kind == 'json':
+            file.seek(file.tell() - 2)
+            file.write('\n]\n')
+    return path
+
+
+def metrics_file(data_dir, kind, size):
+    # Synthetic files are generated once per data directory and reused by every case
+    path = os.path.join(data_dir, f"metrics_{size}.{kind}")
+    if not os.path.exists(path):
+        write_metrics_file(path + '.tmp', kind, size)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def append_rows(path, kind, rows, start):
+    text = format_rows(kind, *metric_block(np.random.default_rng(start), start, rows))
+    with open(path, 'a') as file:
+        file.write(text)
+
+
+SQUEUE = '''#!/bin/sh
+echo call >> "$(dirname "$0")/squeue.calls"
+awk -v n="${BENCH_JOBS:-5000}" 'BEGIN { for (i = 1; i <= n; i++) {
+    state = i % 3 ? "RUNNING" : "PENDING"; part = i % 2 ? "gpu" : "cpu"
+    printf "%d|%s|user%d|%s|1:00:00|%d|node%03d|train_%d\\n", i, part, i % 20, state, i % 4 + 1, i % 100, i } }'
+'''
+SBATCH = '''#!/bin/sh
+counter="$(dirname "$0")/sbatch.counter"
+id=$(( $(cat "$counter" 2>/dev/null || echo 100000) + 1 ))
+echo $id > "$counter"
+echo $id
+'''
+SCANCEL = '''#!/bin/sh
+exit 0
+'''
+SACCT = '''#!/bin/sh
+exit 0
+'''
+
+
+def fake_slurm(directory):
+    # squeue, sbatch, scancel and sacct stand-ins for the SSH server's PATH
+    os.makedirs(directory, exist_ok=True)
+    for name, script in [('squeue', SQUEUE), ('sbatch', SBATCH), ('scancel', SCANCEL), ('sacct', SACCT)]:
+        path = os.path.join(directory, name)
+        with open(path, 'w') as file:
+            file.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+def squeue_calls(directory):
+    path = os.path.join(directory, 'squeue.calls')
+    if not os.path.exists(path):
+        return 0
+    with open(path) as file:
+        return len(file.readlines())
+
+
+def job_scripts(directory, count):
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(directory, f"job_{i}.sh"), 'w') as file:
+            file.write(f"#!/bin/sh\n#SBATCH --job-name=bench_{i}\necho {i}\n")
+    return os.path.join(directory, '*.sh')
+
+
+def write_json(path, value):
+    with open(path, 'w') as file:
+        json.dump(value, file, indent=2, sort_keys=True)
+        file.write('\n')
@@ -0,0 +1,54 @@
+import itertools
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text, **kwargs):
+        return await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+
+    async def answer(self, text, **kwargs):
+        return await self.bot.send_message(self.chat_id, text)
+
+    async def answer_document(self, document, **kwargs):
+        return await self.bot.send_document(self.chat_id, document)
+
+
+class FakeBot:
+    # Stands in for aiogram.Bot: records every API call instead of sending it
+    def __init__(self):
+        self.calls = []
+        self.message_ids = itertools.count(1)
+
+    def new_message(self, chat_id):
+        return FakeMessage(self, chat_id, next(self.message_ids))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send_message', chat_id, len(text)))
+        return self.new_message(chat_id)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.calls.append(('send_photo', chat_id, len(photo.data)))
+        return self.new_message(chat_id)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.calls.append(('send_document', chat_id, 0))
+        return self.new_message(chat_id)
+
+    async def edit_message_media(self, media, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(('edit_message_media', chat_id, len(media.media.data)))
+        return FakeMessage(self, chat_id, message_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls.append(('edit_message_text', chat_id, len(text)))
+        return FakeMessage(self, chat_id, message_id)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        self.calls.append(('delete_message', chat_id, message_id))
+        return True
+
+    def count(self, method):
+        return sum(1 for call in self.calls if call[0] == method)
@@ -0,0 +1,154 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+from benchmarks import data
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_SIZES = '1M,10M'  # 100M and 1G are opt-in: generating and parsing them takes minutes
+LOWER_IS_BETTER = ('_s', '_ms', '_rss_mb')
+HIGHER_IS_BETTER = ('_per_s',)
+TAIL_MARKERS = ('_p95_', '_p99_')  # Reported, but too noisy over a few samples to fail a run
+UNGATED = ('children_peak_rss_mb',)  # Render workers are only counted once reaped, which depends on exit timing
+NOISE_FLOOR = {'_s': 0.25, '_ms': 25, '_rss_mb': 20}  # Smaller absolute differences never count as regressions
+
+
+def peak_rss_mb():
+    # VmHWM starts over at exec, while ru_maxrss keeps the high-water mark of the parent process
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_child(case, size, data_dir):
+    # Runs in its own process, so the reported peak RSS belongs to this case alone
+    from benchmarks.cases import CASES
+    function, sized = CASES[case]
+    context = {'data_dir': data_dir, 'size': data.parse_size(size) if sized else None}
+    start = time.perf_counter()
+    result = function(context)
+    result['wall_s'] = time.perf_counter() - start
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['children_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def run_case(case, size, data_dir):
+    command = [sys.executable, '-m', 'benchmarks.run', '--child', case, '--size', size, '--data-dir', data_dir]
+    process = subprocess.run(command, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"{case} [{size}] failed:\n{process.stderr.strip()}")
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def direction(metric):
+    # 1 when a larger value is a regression, -1 when a smaller one is, 0 for informational values
+    if metric in UNGATED or any(marker in metric for marker in TAIL_MARKERS):
+        return 0
+    if metric.endswith(HIGHER_IS_BETTER):
+        return -1
+    if metric.endswith(LOWER_IS_BETTER):
+        return 1
+    return 0
+
+
+def compare(key, result, baseline, tolerance):
+    regressions = []
+    for metric, expected in baseline.get(key, {}).items():
+        actual = result.get(metric)
+        sign = direction(metric)
+        if not sign or not isinstance(actual, (int, float)) or not isinstance(expected, (int, float)):
+            continue
+        floor = next((value for suffix, value in NOISE_FLOOR.items() if metric.endswith(suffix)), 0)
+        if sign > 0 and actual > expected * (1 + tolerance) and actual - expected > floor:
+            regressions.append(f"{key} {metric}: {actual:.4g} > {expected:.4g}")
+        elif sign < 0 and actual < expected * (1 - tolerance):
+            regressions.append(f"{key} {metric}: {actual:.4g} < {expected:.4g}")
+    return regressions
+
+
+def format_result(key, result):
+    values = ', '.join(f"{metric}={value:.4g}" if isinstance(value, float) else f"{metric}={value}"
+                       for metric, value in result.items())
+    return f"{key}: {values}"
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def main(argv=None):
+    warnings.filterwarnings('ignore', module='paramiko')
+    from benchmarks.cases import CASES
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description="loggerbot benchmarks")
+    parser.add_argument('--cases', default=','.join(CASES), help="comma separated cases")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="file sizes of the sized cases, e.g. 1M,10M,100M,1G")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed relative slowdown, 0.5 is 50%%")
+    parser.add_argument('--data-dir', help="where the synthetic files are kept, a temporary directory by default")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--size', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        logging.basicConfig(level=logging.WARNING)
+        run_child(args.child, args.size, args.data_dir)
+        return 0
+
+    cases = args.cases.split(',')
+    for case in cases:
+        if case not in CASES:
+            parser.error(f"unknown case {case}, choose from {', '.join(CASES)}")
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='loggerbot-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    if any(CASES[case][1] for case in cases):
+        # Generated up front, so no case pays for writing its input
+        for size in args.sizes.split(','):
+            for kind in data.KINDS:
+                data.metrics_file(data_dir, kind, data.parse_size(size))
+    baseline = load_baseline(args.baseline)
+    results, regressions, failures = {}, [], []
+    for case in cases:
+        sizes = args.sizes.split(',') if CASES[case][1] else ['-']
+        for size in sizes:
+            key = case if size == '-' else f"{case}[{size}]"
+            try:
+                results[key] = run_case(case, size, data_dir)
+            except Exception as e:
+                failures.append(str(e))
+                print(f"{key}: FAILED", flush=True)
+                continue
+            print(format_result(key, results[key]), flush=True)
+            regressions.extend(compare(key, results[key], baseline, args.tolerance))
+
+    if not args.data_dir:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    if args.update_baseline:
+        data.write_json(args.baseline, {**baseline, **results})
+        print(f"Baseline written to {args.baseline}")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if regressions:
+        print("Regressions:\n" + '\n'.join(regressions), file=sys.stderr)
+    return 1 if failures or (regressions and not args.update_baseline) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+
+# A stand-in for the cluster login node: accepts any password, serves SFTP from
+# the local file system and runs exec requests with the local shell.
+
+host_key = None
+
+
+class Handle(SFTPHandle):
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class SFTPInterface(SFTPServerInterface):
+    def list_folder(self, path):
+        attributes = []
+        for name in os.listdir(path):
+            attrs = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+            attrs.filename = name
+            attributes.append(attrs)
+        return attributes
+
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(path))
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        fd = os.open(path, flags, 0o666)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        os.remove(path)
+        return SFTP_OK
+
+    def rename(self, source, destination):
+        os.rename(source, destination)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+
+class Server(paramiko.ServerInterface):
+    def __init__(self, env):
+        self.env = env
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_global_request(self, kind, msg):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_command, args=(channel, command, self.env), daemon=True).start()
+        return True
+
+
+def pump(source, send):
+    while True:
+        data = os.read(source.fileno(), 32768)
+        if not data:
+            return
+        send(data)
+
+
+def feed(channel, process):
+    try:
+        while True:
+            data = channel.recv(32768)
+            if not data:
+                break
+            process.stdin.write(data)
+            process.stdin.flush()
+    except Exception:
+        pass
+    try:
+        process.stdin.close()
+    except Exception:
+        pass
+
+
+def run_command(channel, command, env):
+    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env)
+    readers = [threading.Thread(target=pump, args=(process.stdout, channel.sendall)),
+               threading.Thread(target=pump, args=(process.stderr, channel.sendall_stderr))]
+    for reader in readers:
+        reader.start()
+    threading.Thread(target=feed, args=(channel, process), daemon=True).start()
+    for reader in readers:
+        reader.join()
+    status = process.wait()
+    channel.send_exit_status(status if status >= 0 else 128 - status)  # Killed by a signal, as a shell reports it
+    channel.close()
+
+
+def handle_connection(connection, env):
+    # Without TCP_NODELAY small SFTP replies wait for delayed ACKs, 40 ms each on loopback
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    transport = paramiko.Transport(connection)
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler('sftp', SFTPServer, SFTPInterface)
+    transport.start_server(server=Server(env))
+
+
+def accept_loop(sock, env):
+    while True:
+        connection, _ = sock.accept()
+        threading.Thread(target=handle_connection, args=(connection, env), daemon=True).start()
+
+
+def serve(bin_dir=None):
+    # Starts the server on a free local port and returns the port
+    global host_key
+    if host_key is None:
+        host_key = paramiko.RSAKey.generate(2048)
+    env = dict(os.environ)
+    if bin_dir is not None:
+        env['PATH'] = bin_dir + os.pathsep + env['PATH']
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(100)
+    threading.Thread(target=accept_loop, args=(sock, env), daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def connect(port):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.connect('127.0.0.1', port=port, username='bench', password='bench', look_for_keys=False,
+                   allow_agent=False, sock=sock)
+    return client
@@ -1,3 +1,72 @@
 API_TOKEN = 'Your_API_Token'
 user_ssh_clients = {}
-monitoring_tasks = {}
\ No newline at end of file
+monitoring_tasks = {}
+
+SSH_POOL_SIZE = 16  # Threads running blocking paramiko calls
+SSH_TIMEOUT = 60  # Seconds for a single connect/exec/stat call
+TRANSFER_TIMEOUT = 3600  # Seconds for a whole file transfer
+EXECUTE_TIMEOUT = 600  # Seconds for a command started with /execute
+EXECUTE_UPDATE_INTERVAL = 2  # Seconds between edits of the /execute output message
+EXECUTE_POLL_INTERVAL = 0.5  # Seconds a reader thread waits for new command output
+
+MONITOR_INTERVAL = 30  # Default seconds between checks of a monitored file
+MONITOR_TICK = 1  # Seconds between scheduler passes over monitoring_tasks
+MONITOR_IDLE_BACKOFF = 1.5  # Interval multiplier while a file stays the same
+MONITOR_MAX_IDLE_FACTOR = 8  # Idle interval never exceeds MONITOR_INTERVAL * this
+MONITOR_MAX_ERROR_DELAY = 600  # Cap for the exponential backoff on errors
+MONITOR_JITTER = 0.1  # Random +-10% spread of the next check time
+MONITOR_MAX_RUNS = 20  # Files of a directory or glob task overlaid in one plot, the most recently changed ones
+MONITOR_TASK_MEMORY = 16 * 2 ** 20  # Bytes of history kept per monitored file; older rows are thinned out beyond it
+MONITOR_MEMORY_BUDGET = 256 * 2 ** 20  # Bytes of history all monitored files keep together
+MONITOR_READ_BLOCK = 8 * 2 ** 20  # Bytes of a monitored file downloaded and parsed at once
+MONITOR_WATCH = True  # Follow monitored files with inotifywait (or a python loop) on the remote host instead of polling
+MONITOR_WATCH_DEBOUNCE = 2  # Seconds change events of a file are collected before it is read
+MONITOR_WATCH_RECHECK = 600  # Seconds between safety polls of a watched file
+MONITOR_WATCH_RETRY = 60  # Seconds before a dropped watch channel is opened again, polling meanwhile
+MONITOR_WATCH_REMOTE_POLL = 1  # Seconds between directory scans of the python watcher on hosts without inotifywait
+
+PLOT_BACKEND = 'plotly'  # 'plotly' (kaleido) or 'matplotlib' (Agg)
+RENDER_WORKERS = 2  # Processes rendering plots off the event loop
+RENDER_TIMEOUT = 60  # Seconds for a single plot render
+PLOT_MAX_POINTS = 3000  # Points per plotted series after downsampling
+LOG_CHUNK_LINES = 200000  # Lines parsed at once when reading .log/.txt files
+JSON_CHUNK_CHARS = 8 * 2 ** 20  # Characters of a .json/.jsonl/.ndjson file decoded at once
+METRICS_PREFIX_BYTES = 65536  # First read when looking for the header of a metrics file
+METRICS_SCHEMA_CACHE_SIZE = 1024  # Remembered (host, path, size, mtime) -> metrics entries
+REMOTE_AGGREGATION = False  # Parse and downsample monitored files on the remote host when it has python
+TRANSFER_BLOCK_SIZE = 262144  # Bytes per read/write call of a file transfer
+TRANSFER_BATCH_BYTES = 33554432  # Bytes requested at once by a pipelined download
+TRANSFER_PARALLEL_REQUESTS = 64  # SFTP read requests kept in flight
+TRANSFER_COMPRESSION = False  # Stream transfers through gzip when the remote host has it
+TRANSFER_PROGRESS_INTERVAL = 3  # Seconds between progress message updates
+SSH_KEEPALIVE = 30  # Seconds between transport keepalive packets
+SSH_HEALTH_INTERVAL = 30  # Seconds between connection health checks
+SSH_RECONNECT_DELAY = 5  # First delay before reconnecting, doubled on every failure
+SSH_MAX_RECONNECT_DELAY = 300  # Cap for the reconnect delay
+QUEUE_CACHE_TTL = 15  # Seconds an squeue snapshot is shared before it is refreshed
+QUEUE_PAGE_SIZE = 30  # Jobs per /show_queue page
+JOB_WATCH_INTERVAL = 60  # Seconds between batched state checks of submitted jobs
+CANCEL_MAX_RANGE = 1000  # Largest ID range accepted by /cancel_job
+SEND_GLOBAL_RATE = 25  # Messages per second the bot sends in total
+SEND_CHAT_INTERVAL = 1.0  # Minimum seconds between two messages to one chat
+SEND_MAX_RETRIES = 3  # Flood-control retries of one message before it is dropped
+RENDER_CACHE_ENTRIES = 64  # Rendered plots kept for reuse
+RENDER_CACHE_BYTES = 32 * 2 ** 20  # Total size of the kept plots
+STORE_PATH = 'loggerbot.db'  # SQLite database with connection details and monitoring tasks
+STORE_FLUSH_INTERVAL = 1.0  # Seconds changes are collected before they are written in one transaction
+STORE_BATCH_SIZE = 500  # Pending changes that trigger an early write
+BOT_MODE = 'polling'  # 'polling' or 'webhook'
+WEBHOOK_URL = ''  # Public https://host[:port] Telegram sends updates to; empty keeps the registered webhook
+WEBHOOK_PATH = '/webhook'  # Path of the webhook endpoint
+WEBHOOK_SECRET = ''  # Checked against the X-Telegram-Bot-Api-Secret-Token header when set
+WEBHOOK_LISTEN = '0.0.0.0'  # Address the webhook server binds to
+WEBHOOK_PORT = 80  # Port the webhook server listens on
+WEBHOOK_WORKERS = 1  # Worker processes; updates are sharded between them by user_id
+WEBHOOK_STOP_TIMEOUT = 20  # Seconds a stopping worker waits for the updates it is handling
+FSM_STORAGE = 'memory'  # 'memory', 'sqlite' (shared by workers, kept across restarts) or 'redis'
+FSM_REDIS_URL = 'redis://localhost:6379/0'  # Used when FSM_STORAGE = 'redis'
+WARM_UP_DELAY = 5  # Seconds after startup before the plotting stack and render workers are loaded
+ADMIN_IDS = []  # Telegram user ids allowed to use /stats
+STATS_WINDOW = 1024  # Latest durations per span used for the percentiles
+METRICS_LISTEN = '127.0.0.1'  # Address of the Prometheus /metrics endpoint
+METRICS_PORT = 9100  # Port of the /metrics endpoint, worker N uses METRICS_PORT + N; 0 disables it
@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import logging
+import select
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SSH_POOL_SIZE, SSH_TIMEOUT
+from functions.instrumentation import span, count, register_gauge
+
+READ_SIZE = 32768
+
+executor = ThreadPoolExecutor(max_workers=SSH_POOL_SIZE, thread_name_prefix='ssh')
+register_gauge('ssh_pool_queue', lambda: executor._work_queue.qsize())
+
+
+async def run_blocking(func, *args, timeout=SSH_TIMEOUT, on_cancel=None, **kwargs):
+    # Runs a blocking paramiko call in the SSH thread pool. A thread cannot be
+    # interrupted, so on timeout or cancellation `on_cancel` is called to close
+    # whatever the call is blocked on (a channel, an SFTP session).
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if on_cancel is not None:
+            try:
+                on_cancel()
+            except Exception as e:
+                logging.error(f"Failed to abort blocking call: {e}")
+        raise
+
+
+def _exec_command(ssh_client, command, channels, timeout, raw):
+    stdin, stdout, stderr = ssh_client.exec_command(command, timeout=timeout)
+    channel = stdout.channel
+    channels.append(channel)
+    channel.shutdown_write()
+    output, error = [], []
+    # Both streams are drained together so a chatty stderr cannot block stdout
+    while True:
+        if channel.recv_ready():
+            output.append(channel.recv(READ_SIZE))
+        elif channel.recv_stderr_ready():
+            error.append(channel.recv_stderr(READ_SIZE))
+        elif channel.exit_status_ready() or channel.closed:
+            break
+        else:
+            select.select([channel], [], [], 1)
+    # Pick up whatever arrived together with the exit status
+    while channel.recv_ready():
+        output.append(channel.recv(READ_SIZE))
+    while channel.recv_stderr_ready():
+        error.append(channel.recv_stderr(READ_SIZE))
+    channel.close()
+    if raw:
+        return b''.join(output), b''.join(error)
+    return b''.join(output).decode('utf-8', errors='replace').strip(), \
+        b''.join(error).decode('utf-8', errors='replace').strip()
+
+
+def _close_channels(channels):
+    for channel in channels:
+        channel.close()
+
+
+async def exec_command(ssh_client, command, timeout=SSH_TIMEOUT, raw=False):
+    # Returns (stdout, stderr) of a remote command as stripped strings, or as bytes with raw=True
+    channels = []
+    with span('ssh_exec'):
+        output, error = await run_blocking(_exec_command, ssh_client, command, channels, timeout, raw,
+                                           timeout=timeout, on_cancel=functools.partial(_close_channels, channels))
+    count('ssh_exec_bytes', len(output) + len(error))
+    return output, error
+
+
+async def connect(ssh_client, timeout=SSH_TIMEOUT, **kwargs):
+    connect_call = functools.partial(ssh_client.connect, timeout=timeout, banner_timeout=timeout,
+                                     auth_timeout=timeout, **kwargs)
+    return await run_blocking(connect_call, timeout=timeout, on_cancel=ssh_client.close)
+
+
+async def open_sftp(ssh_client, timeout=SSH_TIMEOUT):
+    return await run_blocking(ssh_client.open_sftp, timeout=timeout)
+
+
+async def close(obj):
+    await run_blocking(obj.close)
@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+import paramiko
+
+from config import user_ssh_clients
+from config import SSH_KEEPALIVE, SSH_HEALTH_INTERVAL, SSH_RECONNECT_DELAY, SSH_MAX_RECONNECT_DELAY
+from functions import async_ssh
+
+shared_connections = {}  # (host, port, username, credential hash) -> SharedConnection
+watcher_task = None
+
+
+class SharedConnection:
+    # One authenticated transport per host and account. Every user and task on
+    # it opens its own channels, and reconnects replace the client in place.
+    def __init__(self, key, host, port, username, password=None, pkey=None):
+        self.key = key
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.pkey = pkey
+        self.client = None
+        self.users = set()
+        self.latency = None
+        self.reconnects = 0
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_error = None
+        self.lock = asyncio.Lock()
+
+    def is_active(self):
+        transport = self.client.get_transport() if self.client is not None else None
+        return transport is not None and transport.is_active()
+
+    async def connect(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        await async_ssh.connect(client, hostname=self.host, port=self.port, username=self.username,
+                                password=self.password, pkey=self.pkey)
+        client.get_transport().set_keepalive(SSH_KEEPALIVE)
+        old_client, self.client = self.client, client
+        if old_client is not None:
+            old_client.close()
+
+    async def reconnect(self):
+        async with self.lock:
+            if self.is_active():
+                return True
+            loop = asyncio.get_running_loop()
+            if loop.time() < self.next_attempt:
+                return False
+            try:
+                await self.connect()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                delay = min(SSH_RECONNECT_DELAY * 2 ** (self.failures - 1), SSH_MAX_RECONNECT_DELAY)
+                self.next_attempt = loop.time() + delay
+                logging.error(f"Reconnect to {self.username}@{self.host}:{self.port} failed, next try in {delay} s: {e}")
+                return False
+            self.failures = 0
+            self.reconnects += 1
+            self.last_error = None
+            logging.info(f"Reconnected to {self.username}@{self.host}:{self.port}")
+            return True
+
+    def measure_latency(self):
+        # Round trip of an OpenSSH keepalive global request, answered even when refused
+        transport = self.client.get_transport()
+        start = time.monotonic()
+        transport.global_request('keepalive@openssh.com', wait=True)
+        self.latency = time.monotonic() - start
+        return self.latency
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+
+class UserConnection:
+    # Stored in user_ssh_clients; behaves like the paramiko.SSHClient it wraps
+    def __init__(self, shared):
+        self.shared = shared
+
+    def exec_command(self, *args, **kwargs):
+        return self.shared.client.exec_command(*args, **kwargs)
+
+    def open_sftp(self):
+        return self.shared.client.open_sftp()
+
+    def get_transport(self):
+        return self.shared.client.get_transport()
+
+    def close(self):
+        pass
+
+
+def credential_hash(password, pkey):
+    # Users share a transport only if they authenticated with the same secret
+    digest = hashlib.sha256()
+    if password is not None:
+        digest.update(password.encode('utf-8'))
+    if pkey is not None:
+        digest.update(pkey.get_fingerprint())
+    return digest.hexdigest()
+
+
+async def connect(user_id, host, port, username, password=None, pkey=None):
+    key = (host, port, username, credential_hash(password, pkey))
+    shared = shared_connections.get(key)
+    if shared is None or not shared.is_active():
+        if shared is None:
+            shared = SharedConnection(key, host, port, username, password, pkey)
+        await shared.connect()
+        shared_connections[key] = shared
+    existing = user_ssh_clients.get(user_id)
+    if existing is not None and existing.shared is not shared:
+        # A repeated /connect with the same account keeps the shared connection it already uses
+        await disconnect(user_id)
+    shared.users.add(user_id)
+    user_ssh_clients[user_id] = UserConnection(shared)
+    ensure_watcher()
+    return user_ssh_clients[user_id]
+
+
+async def disconnect(user_id):
+    connection = user_ssh_clients.pop(user_id, None)
+    if connection is None:
+        return
+    shared = connection.shared
+    shared.users.discard(user_id)
+    if not shared.users:
+        shared_connections.pop(shared.key, None)
+        await async_ssh.close(shared)
+
+
+def connection_health(user_id):
+    connection = user_ssh_clients.get(user_id)
+    if connection is None:
+        return None
+    shared = connection.shared
+    return {
+        'host': f"{shared.username}@{shared.host}:{shared.port}",
+        'active': shared.is_active(),
+        'latency': shared.latency,
+        'reconnects': shared.reconnects,
+        'users': len(shared.users),
+        'last_error': shared.last_error,
+    }
+
+
+async def check_connection(shared):
+    if not shared.is_active():
+        await shared.reconnect()
+        return
+    try:
+        await async_ssh.run_blocking(shared.measure_latency)
+    except Exception as e:
+        logging.error(f"Health check of {shared.host} failed: {e}")
+        shared.client.close()
+        await shared.reconnect()
+
+
+async def watch_connections():
+    while True:
+        await asyncio.sleep(SSH_HEALTH_INTERVAL)
+        await asyncio.gather(*(check_connection(shared) for shared in list(shared_connections.values())),
+                             return_exceptions=True)
+
+
+def ensure_watcher():
+    global watcher_task
+    if watcher_task is None or watcher_task.done():
+        watcher_task = asyncio.create_task(watch_connections())
@@ -0,0 +1,130 @@
+import asyncio
+import itertools
+import logging
+import os
+import select
+import tempfile
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+
+from config import EXECUTE_TIMEOUT, EXECUTE_UPDATE_INTERVAL, EXECUTE_POLL_INTERVAL, SSH_TIMEOUT
+from functions.async_ssh import run_blocking
+from functions.instrumentation import span, count, register_gauge
+
+MESSAGE_LIMIT = 4000  # Output longer than this goes out as a file
+READ_SIZE = 32768
+
+running_commands = {}  # run_id -> (user_id, Channel)
+run_ids = itertools.count(1)
+register_gauge('running_commands', lambda: len(running_commands))
+
+
+def open_channel(ssh_client, command):
+    channel = ssh_client.get_transport().open_session(timeout=SSH_TIMEOUT)
+    channel.exec_command(command)
+    channel.shutdown_write()
+    return channel
+
+
+def new_output():
+    # Only the tail stays in memory, the full output is spooled to a temporary file
+    spool = tempfile.NamedTemporaryFile(prefix='execute_', suffix='.txt', delete=False)
+    return {'tail': bytearray(), 'size': 0, 'spool': spool}
+
+
+def add_output(output, data):
+    output['spool'].write(data)
+    output['size'] += len(data)
+    output['tail'] += data
+    if len(output['tail']) > MESSAGE_LIMIT:
+        del output['tail'][:-MESSAGE_LIMIT]
+
+
+def pump_channel(channel, output):
+    # Waits up to EXECUTE_POLL_INTERVAL for data on either stream and drains both.
+    # Returns True once the command has exited and everything was read.
+    select.select([channel], [], [], EXECUTE_POLL_INTERVAL)
+    while channel.recv_ready() or channel.recv_stderr_ready():
+        if channel.recv_ready():
+            add_output(output, channel.recv(READ_SIZE))
+        if channel.recv_stderr_ready():
+            add_output(output, channel.recv_stderr(READ_SIZE))
+    return channel.closed or (channel.exit_status_ready() and not channel.recv_ready()
+                              and not channel.recv_stderr_ready())
+
+
+def tail_text(output):
+    text = output['tail'].decode('utf-8', errors='replace')
+    if output['size'] > len(output['tail']):
+        text = "...\n" + text[-(MESSAGE_LIMIT - 4):]
+    return text.strip() or "Нет вывода"
+
+
+def cancel_markup(run_id):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Отменить", callback_data=f"cancel_exec_{run_id}")]])
+
+
+def cancel_command(run_id, user_id):
+    entry = running_commands.get(run_id)
+    if entry is None or entry[0] != user_id:
+        return False
+    del running_commands[run_id]
+    entry[1].close()
+    return True
+
+
+async def stream_command(message, ssh_client, command, timeout=EXECUTE_TIMEOUT):
+    with span('execute'):
+        await run_streamed(message, ssh_client, command, timeout)
+
+
+async def run_streamed(message, ssh_client, command, timeout):
+    user_id = message.from_user.id
+    run_id = next(run_ids)
+    status = await message.answer("Команда выполняется...", reply_markup=cancel_markup(run_id))
+    output = new_output()
+    channel = None
+    try:
+        channel = await run_blocking(open_channel, ssh_client, command)
+        running_commands[run_id] = (user_id, channel)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        last_edit = loop.time()
+        shown_size = 0
+        timed_out = False
+        while not await run_blocking(pump_channel, channel, output, on_cancel=channel.close):
+            now = loop.time()
+            if now > deadline:
+                timed_out = True
+                channel.close()
+                break
+            if output['size'] != shown_size and now - last_edit >= EXECUTE_UPDATE_INTERVAL:
+                shown_size = output['size']
+                last_edit = now
+                try:
+                    await status.edit_text(tail_text(output), reply_markup=cancel_markup(run_id))
+                except Exception as e:
+                    logging.error(f"Failed to update command output: {e}")
+
+        if timed_out:
+            footer = f"Команда не завершилась за {timeout} секунд и была прервана."
+        elif run_id not in running_commands:
+            footer = "Команда отменена."
+        else:
+            footer = f"Код завершения: {channel.recv_exit_status()}"
+        output['spool'].close()
+        text = tail_text(output)
+        await status.edit_text(f"{text}\n\n{footer}"[-MESSAGE_LIMIT:])
+        if output['size'] > MESSAGE_LIMIT:
+            await message.answer_document(FSInputFile(output['spool'].name, filename='output.txt'),
+                                          caption="Полный вывод команды")
+    except Exception as e:
+        await message.answer(f"Ошибка выполнения команды: {e}")
+    finally:
+        count('execute_output_bytes', output['size'])
+        running_commands.pop(run_id, None)
+        if channel is not None:
+            channel.close()
+        output['spool'].close()
+        os.remove(output['spool'].name)
@@ -1,17 +1,205 @@
+import asyncio
+import hashlib
 import logging
 import os
+import shlex
+import zlib
 
-async def upload_file(ssh_client, local_path, remote_path):
+from config import (TRANSFER_TIMEOUT, TRANSFER_BLOCK_SIZE, TRANSFER_BATCH_BYTES, TRANSFER_PARALLEL_REQUESTS,
+                    TRANSFER_COMPRESSION, TRANSFER_PROGRESS_INTERVAL)
+from functions.async_ssh import run_blocking, open_sftp
+from functions.instrumentation import span, count
+
+PART_SUFFIX = '.part'
+CHECK_BYTES = 65536  # Tail of a partial file compared when the remote has no md5sum
+
+
+def new_progress(total=0):
+    return {'done': 0, 'total': total}
+
+
+def remote_output(ssh_client, command):
+    stdin, stdout, stderr = ssh_client.exec_command(command)
+    output = stdout.read().decode('utf-8', errors='replace').strip()
+    if stdout.channel.recv_exit_status() != 0:
+        return None
+    return output
+
+
+def has_remote_gzip(ssh_client):
+    return TRANSFER_COMPRESSION and bool(remote_output(ssh_client, 'command -v gzip'))
+
+
+def local_md5(path, length):
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        while length > 0:
+            data = file.read(min(TRANSFER_BLOCK_SIZE, length))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    return digest.hexdigest()
+
+
+def remote_md5(ssh_client, remote_path, length):
+    output = remote_output(ssh_client, f'head -c {length} -- {shlex.quote(remote_path)} | md5sum')
+    return output.split()[0] if output else None
+
+
+def same_prefix(ssh_client, sftp, remote_path, local_path, length):
+    # The partial file is reused only if its content matches the start of the source
+    checksum = remote_md5(ssh_client, remote_path, length)
+    if checksum is not None:
+        return checksum == local_md5(local_path, length)
+    tail = min(CHECK_BYTES, length)
+    with sftp.open(remote_path, 'rb') as remote_file, open(local_path, 'rb') as local_file:
+        remote_file.seek(length - tail)
+        local_file.seek(length - tail)
+        return remote_file.read(tail) == local_file.read(tail)
+
+
+def download_sftp(ssh_client, sftp, remote_path, local_path, progress):
+    part_path = local_path + PART_SUFFIX
+    size = sftp.stat(remote_path).st_size
+    progress['total'] = size
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > size or (offset and not same_prefix(ssh_client, sftp, remote_path, part_path, offset)):
+        offset = 0
+    if offset:
+        logging.info(f"Resuming download of {remote_path} from byte {offset}")
+    progress['done'] = offset
+    with sftp.open(remote_path, 'rb') as remote_file, open(part_path, 'r+b' if offset else 'wb') as local_file:
+        local_file.seek(offset)
+        while offset < size:
+            # readv keeps TRANSFER_PARALLEL_REQUESTS reads in flight; batches bound the buffered data
+            batch = min(TRANSFER_BATCH_BYTES, size - offset)
+            chunks = [(start, min(TRANSFER_BLOCK_SIZE, offset + batch - start))
+                      for start in range(offset, offset + batch, TRANSFER_BLOCK_SIZE)]
+            for data in remote_file.readv(chunks, TRANSFER_PARALLEL_REQUESTS):
+                local_file.write(data)
+                progress['done'] += len(data)
+            offset += batch
+    os.replace(part_path, local_path)
+
+
+def download_gzip(ssh_client, sftp, remote_path, local_path, progress):
+    progress['total'] = sftp.stat(remote_path).st_size
+    stdin, stdout, stderr = ssh_client.exec_command(f'gzip -c -- {shlex.quote(remote_path)}')
+    decompressor = zlib.decompressobj(wbits=31)
+    part_path = local_path + PART_SUFFIX
+    with open(part_path, 'wb') as local_file:
+        while True:
+            data = stdout.read(TRANSFER_BLOCK_SIZE)
+            if not data:
+                break
+            data = decompressor.decompress(data)
+            local_file.write(data)
+            progress['done'] += len(data)
+        local_file.write(decompressor.flush())
+    if stdout.channel.recv_exit_status() != 0:
+        raise IOError(stderr.read().decode('utf-8', errors='replace').strip())
+    os.replace(part_path, local_path)
+
+
+def upload_sftp(ssh_client, sftp, local_path, remote_path, progress):
+    part_path = remote_path + PART_SUFFIX
+    size = os.path.getsize(local_path)
+    progress['total'] = size
+    try:
+        offset = sftp.stat(part_path).st_size
+    except IOError:
+        offset = 0
+    if offset > size or (offset and not same_prefix(ssh_client, sftp, part_path, local_path, offset)):
+        offset = 0
+    if offset:
+        logging.info(f"Resuming upload of {local_path} from byte {offset}")
+    progress['done'] = offset
+    with open(local_path, 'rb') as local_file, sftp.open(part_path, 'r+b' if offset else 'wb') as remote_file:
+        # Pipelined writes do not wait for each acknowledgement before sending the next block
+        remote_file.set_pipelined(True)
+        remote_file.seek(offset)
+        local_file.seek(offset)
+        while True:
+            data = local_file.read(TRANSFER_BLOCK_SIZE)
+            if not data:
+                break
+            remote_file.write(data)
+            progress['done'] += len(data)
+    replace_remote(sftp, part_path, remote_path)
+
+
+def upload_gzip(ssh_client, sftp, local_path, remote_path, progress):
+    progress['total'] = os.path.getsize(local_path)
+    part_path = shlex.quote(remote_path + PART_SUFFIX)
+    stdin, stdout, stderr = ssh_client.exec_command(
+        f'gzip -dc > {part_path} && mv -f -- {part_path} {shlex.quote(remote_path)}')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    with open(local_path, 'rb') as local_file:
+        while True:
+            data = local_file.read(TRANSFER_BLOCK_SIZE)
+            if not data:
+                break
+            stdin.write(compressor.compress(data))
+            progress['done'] += len(data)
+        stdin.write(compressor.flush())
+    stdin.channel.shutdown_write()
+    if stdout.channel.recv_exit_status() != 0:
+        raise IOError(stderr.read().decode('utf-8', errors='replace').strip())
+
+
+def replace_remote(sftp, source, destination):
+    try:
+        sftp.posix_rename(source, destination)
+    except IOError:
+        # Servers without the posix-rename extension refuse to overwrite
+        try:
+            sftp.remove(destination)
+        except IOError:
+            pass
+        sftp.rename(source, destination)
+
+
+def transfer(transfer_function, ssh_client, sftp, source, destination, progress):
+    gzip_function = {download_sftp: download_gzip, upload_sftp: upload_gzip}[transfer_function]
+    if has_remote_gzip(ssh_client):
+        return gzip_function(ssh_client, sftp, source, destination, progress)
+    return transfer_function(ssh_client, sftp, source, destination, progress)
+
+
+async def report_progress(message, progress, title):
+    # Edits one status message at most every TRANSFER_PROGRESS_INTERVAL seconds
+    last_text = None
+    while True:
+        await asyncio.sleep(TRANSFER_PROGRESS_INTERVAL)
+        total = progress['total']
+        percent = progress['done'] * 100 // total if total else 0
+        text = f"{title}: {progress['done'] // 2 ** 20} / {total // 2 ** 20} МБ ({percent}%)"
+        if text != last_text:
+            try:
+                await message.edit_text(text)
+                last_text = text
+            except Exception as e:
+                logging.error(f"Failed to update transfer progress: {e}")
+
+
+async def upload_file(ssh_client, local_path, remote_path, progress=None):
     try:
         if os.path.exists(local_path):
             logging.info(f"Confirmed that {local_path} exists. Proceeding with upload.")
         else:
             return f"Error: File {local_path} was not found locally."
 
-        sftp = ssh_client.open_sftp()
-        logging.info(f"Uploading {local_path} to {remote_path}")
-        sftp.put(local_path, remote_path)
-        sftp.close()
+        progress = progress if progress is not None else new_progress()
+        sftp = await open_sftp(ssh_client)
+        try:
+            logging.info(f"Uploading {local_path} to {remote_path}")
+            with span('transfer_upload'):
+                await run_blocking(transfer, upload_sftp, ssh_client, sftp, local_path, remote_path, progress,
+                                   timeout=TRANSFER_TIMEOUT, on_cancel=sftp.close)
+        finally:
+            count('upload_bytes', progress['done'])
+            sftp.close()
         return "Файл успешно загружен."
     except FileNotFoundError as e:
         logging.error(f"FileNotFoundError: {e}")
@@ -23,11 +211,17 @@ async def upload_file(ssh_client, local_path, remote_path):
 
 
 
-async def download_file(ssh_client, remote_path, local_path):
+async def download_file(ssh_client, remote_path, local_path, progress=None):
     try:
-        sftp = ssh_client.open_sftp()
-        sftp.get(remote_path, local_path)
-        sftp.close()
+        progress = progress if progress is not None else new_progress()
+        sftp = await open_sftp(ssh_client)
+        try:
+            with span('transfer_download'):
+                await run_blocking(transfer, download_sftp, ssh_client, sftp, remote_path, local_path, progress,
+                                   timeout=TRANSFER_TIMEOUT, on_cancel=sftp.close)
+        finally:
+            count('download_bytes', progress['done'])
+            sftp.close()
         return "Файл успешно скачан."
     except Exception as e:
-        return f"Ошибка при скачивании файла: {e}"
\ No newline at end of file
+        return f"Ошибка при скачивании файла: {e}"
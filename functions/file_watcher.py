@@ -0,0 +1,195 @@
+import asyncio
+import base64
+import logging
+import os
+import shlex
+import zlib
+
+from config import monitoring_tasks
+from config import SSH_TIMEOUT, MONITOR_WATCH_RETRY, MONITOR_WATCH_REMOTE_POLL
+from functions.async_ssh import run_blocking
+from functions.execute import open_channel
+from functions.instrumentation import count, register_gauge
+
+READ_SIZE = 32768
+READY = b'Watches established.'  # inotifywait reports this on stderr once it is listening
+INOTIFY_EVENTS = ['modify', 'close_write', 'moved_to', 'create', 'delete']
+
+# Runs on hosts without inotify-tools: scans the directories every interval and
+# prints the paths that changed, so only the events cross the network. It exits
+# once the SSH session that started it is gone.
+WATCHER = r'''
+import os, sys, time
+interval, directories = float(sys.argv[1]), sys.argv[2:]
+def scan():
+    found = {}
+    for d in directories:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(d, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found[path] = (st.st_size, st.st_mtime, st.st_ino)
+    return found
+old = scan()
+sys.stderr.write('Watches established.\n')
+sys.stderr.flush()
+while os.getppid() != 1:
+    time.sleep(interval)
+    new = scan()
+    changed = [path for path in set(old) | set(new) if old.get(path) != new.get(path)]
+    if changed:
+        sys.stdout.write(''.join(path + '\n' for path in changed))
+        sys.stdout.flush()
+    old = new
+'''
+
+watchers = {}  # user_id -> FileWatcher
+register_gauge('file_watchers', lambda: sum(1 for watcher in watchers.values() if watcher.established))
+
+
+class FileWatcher:
+    # One long-lived exec channel per user printing the changed files of the
+    # directories the user monitors. While it runs, the tasks are read on its
+    # events; those it has delivered events for are polled only as a safety net.
+    def __init__(self, user_id, directories, transport):
+        self.user_id = user_id
+        self.directories = directories
+        self.transport = transport
+        self.channel = None
+        self.established = False
+        self.closed = False
+        self.retry_at = None  # None: not retried on this transport, the host has no watcher
+        self.output = b''
+        self.errors = b''
+
+
+def watch_command(directories, interval=MONITOR_WATCH_REMOTE_POLL):
+    # inotifywait when the host has it, otherwise the python watcher, exit code 127 without either
+    paths = ' '.join(shlex.quote(directory.rstrip('/') + '/') for directory in directories)
+    events = ' '.join(f"-e {event}" for event in INOTIFY_EVENTS)
+    packed = base64.b64encode(zlib.compress(WATCHER.encode('utf-8'))).decode('ascii')
+    bootstrap = shlex.quote(f"import base64,zlib;exec(zlib.decompress(base64.b64decode('{packed}')))")
+    return (f"if command -v inotifywait >/dev/null 2>&1; then "
+            f"exec inotifywait -m {events} --format '%w%f' -- {paths}; fi; "
+            f"for p in python3 python; do command -v $p >/dev/null 2>&1 && exec $p -c {bootstrap} {interval} {paths}; "
+            f"done; exit 127")
+
+
+def watch_directory(task):
+    directory = task.directory if task.directory is not None else os.path.dirname(task.file_path)
+    return directory or '.'
+
+
+def user_tasks(user_id):
+    return [task for task in monitoring_tasks.get(user_id, {}).values() if not task.cancelled]
+
+
+def sync_watchers(ssh_clients):
+    # Called on every scheduler tick: starts, restarts and stops watch channels so
+    # that every connected user has one covering the directories of their tasks
+    loop = asyncio.get_running_loop()
+    for user_id in list(watchers):
+        if not user_tasks(user_id):
+            stop_watcher(user_id)
+    for user_id in list(monitoring_tasks):
+        tasks = user_tasks(user_id)
+        ssh_client = ssh_clients.get(user_id)
+        transport = ssh_client.get_transport() if ssh_client else None
+        if not tasks or transport is None or not transport.is_active():
+            continue
+        directories = sorted({watch_directory(task) for task in tasks})
+        watcher = watchers.get(user_id)
+        if watcher is not None and watcher.transport is transport and watcher.directories == directories:
+            if not watcher.closed or watcher.retry_at is None or loop.time() < watcher.retry_at:
+                continue
+        stop_watcher(user_id)
+        watcher = watchers[user_id] = FileWatcher(user_id, directories, transport)
+        asyncio.create_task(start_watcher(watcher, ssh_client))
+
+
+async def start_watcher(watcher, ssh_client):
+    try:
+        channel = await run_blocking(open_channel, ssh_client, watch_command(watcher.directories))
+    except Exception as e:
+        logging.error(f"Failed to start file watcher for user_id {watcher.user_id}: {e}")
+        watcher.closed = True
+        watcher.retry_at = asyncio.get_running_loop().time() + MONITOR_WATCH_RETRY
+        return
+    if watcher.closed:
+        # Stopped while the channel was being opened
+        channel.close()
+        return
+    watcher.channel = channel
+    asyncio.get_running_loop().add_reader(channel.fileno(), read_events, watcher)
+
+
+def read_events(watcher):
+    # Runs on the event loop whenever the channel has data, never blocks
+    channel = watcher.channel
+    while channel.recv_ready():
+        watcher.output += channel.recv(READ_SIZE)
+    while channel.recv_stderr_ready():
+        watcher.errors = (watcher.errors + channel.recv_stderr(READ_SIZE))[-READ_SIZE:]
+    now = asyncio.get_running_loop().time()
+    if not watcher.established and READY in watcher.errors:
+        watcher.established = True
+        logging.info(f"Watching {', '.join(watcher.directories)} for user_id {watcher.user_id}")
+        for task in user_tasks(watcher.user_id):
+            # One read catches up with whatever changed before the watch was set up
+            task.notify(now, event=False)
+    *lines, watcher.output = watcher.output.split(b'\n')
+    paths = {os.path.normpath(line.decode('utf-8', errors='replace')) for line in lines if line}
+    if paths:
+        count('monitor_watch_events', len(lines))
+        for task in user_tasks(watcher.user_id):
+            if any(task.watches(path) for path in paths):
+                task.notify(now)
+    if channel.closed or channel.eof_received:
+        asyncio.get_running_loop().remove_reader(channel.fileno())
+        asyncio.create_task(finish_watcher(watcher))
+
+
+async def finish_watcher(watcher):
+    # The channel ended: the tasks go back to polling and the watch is retried later,
+    # or not at all on this connection when the host has neither inotifywait nor python
+    try:
+        status = await run_blocking(watcher.channel.recv_exit_status, timeout=SSH_TIMEOUT)
+    except Exception:
+        status = None
+    if watchers.get(watcher.user_id) is not watcher or watcher.closed:
+        return
+    if status == 127:
+        logging.info(f"No inotifywait or python on the host of user_id {watcher.user_id}, polling monitored files")
+    else:
+        logging.warning(f"File watcher of user_id {watcher.user_id} stopped with status {status}: "
+                        f"{watcher.errors.replace(READY, b'').decode('utf-8', errors='replace').strip()[-500:]}")
+        watcher.retry_at = asyncio.get_running_loop().time() + MONITOR_WATCH_RETRY
+    close_watcher(watcher)
+
+
+def close_watcher(watcher):
+    watcher.closed = True
+    watcher.established = False
+    if watcher.channel is not None:
+        try:
+            asyncio.get_running_loop().remove_reader(watcher.channel.fileno())
+        except Exception:
+            pass
+        watcher.channel.close()
+    now = asyncio.get_running_loop().time()
+    for task in user_tasks(watcher.user_id):
+        if task.watched:
+            task.watched = False
+            task.next_check = min(task.next_check, now)
+
+
+def stop_watcher(user_id):
+    watcher = watchers.pop(user_id, None)
+    if watcher is not None:
+        close_watcher(watcher)
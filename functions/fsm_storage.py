@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE, FSM_REDIS_URL
+from functions import save_load_data
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}'
+);
+'''
+
+
+def storage_key(key):
+    return ':'.join(str(part) for part in [key.bot_id, key.chat_id, key.user_id, key.thread_id,
+                                           key.business_connection_id, key.destiny])
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM states in the bot database, shared by all worker processes and kept across restarts
+    def __init__(self):
+        db = save_load_data.open_store()
+        with save_load_data.database_lock:
+            db.executescript(SCHEMA)
+
+    def execute(self, query, args):
+        with save_load_data.database_lock, save_load_data.open_store() as db:
+            return db.execute(query, args).fetchone()
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self.execute, 'INSERT INTO fsm (key, state) VALUES (?, ?) '
+                                              'ON CONFLICT(key) DO UPDATE SET state = excluded.state',
+                                (storage_key(key), state))
+
+    async def get_state(self, key):
+        row = await asyncio.to_thread(self.execute, 'SELECT state FROM fsm WHERE key = ?', (storage_key(key),))
+        return row[0] if row else None
+
+    async def set_data(self, key, data):
+        await asyncio.to_thread(self.execute, 'INSERT INTO fsm (key, data) VALUES (?, ?) '
+                                              'ON CONFLICT(key) DO UPDATE SET data = excluded.data',
+                                (storage_key(key), json.dumps(data)))
+
+    async def get_data(self, key):
+        row = await asyncio.to_thread(self.execute, 'SELECT data FROM fsm WHERE key = ?', (storage_key(key),))
+        return json.loads(row[0]) if row else {}
+
+    async def close(self):
+        pass
+
+
+def create_storage(backend=FSM_STORAGE):
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'redis':
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE = 'redis' requires the redis package (pip install redis)") from e
+        return RedisStorage.from_url(FSM_REDIS_URL)
+    raise ValueError(f"Unknown FSM storage backend: {backend}")
@@ -9,18 +9,27 @@ import asyncio
 
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import Message, InputFile, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import Message, InputFile, FSInputFile, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
 import kbrds
-from functions.monitor import monitor_file
+from functions.monitor import start_monitoring, stop_monitoring as stop_user_monitoring
+from functions.monitor import MONITOR_FORMATS, is_run_pattern, resolve_runs
 
 router = Router()
 
-from functions.scheduler_interface import submit_job, show_queue, cancel_job
+from functions.scheduler_interface import submit_job, show_queue, cancel_job, parse_queue_filters
 from config import user_ssh_clients
 from config import monitoring_tasks
-from functions.file_handling import upload_file, download_file
+from config import MONITOR_INTERVAL, MONITOR_TICK, ADMIN_IDS
+from functions.file_handling import upload_file, download_file, new_progress, report_progress
 from functions.metrics import get_metrics
+from functions.save_load_data import save_connection_details
+from functions import async_ssh
+from functions import connections
+from functions import rendering
+from functions import instrumentation
+from functions.execute import stream_command, cancel_command
+from functions.job_watcher import track_jobs, job_log_path
 
 class CommandState(StatesGroup):
     awaiting_credentials = State()
@@ -36,8 +45,20 @@ class CommandState(StatesGroup):
     awaiting_metric_selection = State()
     confirming = State()
 
-def setup_handlers(router: Router):
-    from main import bot, saved_connection_details
+queue_filters = {}  # user_id -> filters of the last /show_queue
+
+
+def queue_markup(page, pages):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀", callback_data=f"queue_page_{page - 1}"))
+    buttons.append(InlineKeyboardButton(text="Обновить", callback_data=f"queue_page_{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton(text="▶", callback_data=f"queue_page_{page + 1}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+def setup_handlers(router: Router, bot: Bot, saved_connection_details: dict):
 
     @router.message(Command(commands=['start']))
     async def send_welcome(message: types.Message):
@@ -52,11 +73,12 @@ def setup_handlers(router: Router):
             "Доступные команды:\n"
             "/connect - Подключиться к серверу.\n"
             "/disconnect - Отключиться от сервера.\n"
+            "/status - Состояние подключения к серверу.\n"
             "/execute - Выполнить команду на сервере.\n"
             "/upload - Загрузить файл на сервер.\n"
             "/download - Скачать файл с сервера.\n"
             "/submit_job - Отправить задачу на выполнение.\n"
-            "/show_queue - Просмотр очереди задач.\n"
+            "/show_queue [mine] [partition=...] [state=...] - Просмотр очереди задач.\n"
             "/cancel_job - Отменить задачу.\n"
             "/add_monitoring - Начать мониторинг файла по установленному пути.\n"
             "/stop_monitoring - Остановить мониторинг файла.\n"
@@ -79,6 +101,7 @@ def setup_handlers(router: Router):
             saved_connection_details[user_id]["login"]=parts[0]
             saved_connection_details[user_id]["host"]=parts[1]
             saved_connection_details[user_id]["port"]=int(parts[2]) if len(parts) > 2 else 2222
+            save_connection_details(user_id, parts[1], parts[0], saved_connection_details[user_id]["port"])
             markup = InlineKeyboardMarkup(inline_keyboard=kbrds.keyboard_connecting)
             await message.answer("Выберите метод аутентификации:", reply_markup=markup)
             await state.clear()
@@ -132,22 +155,20 @@ def setup_handlers(router: Router):
         if len(parts) == 1:
             password = parts[0]
 
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             try:
                 key = paramiko.RSAKey.from_private_key_file(pem_file, password)
-                ssh_client.connect(hostname=host, username=username, pkey=key, port=port)
                 user_id = message.from_user.id
-                user_ssh_clients[user_id] = ssh_client
+                await connections.connect(user_id, host, port, username, pkey=key)
                 await message.answer("Успешное подключение к серверу.")
                 await message.answer(
                     "Доступные команды:\n"
                     "/disconnect - Отключиться от сервера.\n"
+                    "/status - Состояние подключения к серверу.\n"
                     "/execute - Выполнить команду на сервере.\n"
                     "/upload - Загрузить файл на сервер.\n"
                     "/download - Скачать файл с сервера.\n"
                     "/submit_job - Отправить задачу на выполнение.\n"
-                    "/show_queue - Просмотр очереди задач.\n"
+                    "/show_queue [mine] [partition=...] [state=...] - Просмотр очереди задач.\n"
                     "/cancel_job - Отменить задачу.\n"
                     "/add_monitoring - Начать мониторинг файла по установленному пути.\n"
                     "/stop_monitoring - Остановить мониторинг файла.\n"
@@ -171,21 +192,19 @@ def setup_handlers(router: Router):
         if len(parts) == 1:
             await state.clear()
             password = parts[0]
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             try:
-                ssh_client.connect(hostname=host, username=username, password=password, port=port)
-                user_ssh_clients[user_id] = ssh_client
+                await connections.connect(user_id, host, port, username, password=password)
                 await message.answer("Успешное подключение к серверу.")
                 await message.answer(
                     "Доступные команды:\n"
                     "/connect - Подключиться к серверу.\n"
                     "/disconnect - Отключиться от сервера.\n"
+                    "/status - Состояние подключения к серверу.\n"
                     "/execute - Выполнить команду на сервере.\n"
                     "/upload - Загрузить файл на сервер.\n"
                     "/download - Скачать файл с сервера.\n"
                     "/submit_job - Отправить задачу на выполнение.\n"
-                    "/show_queue - Просмотр очереди задач.\n"
+                    "/show_queue [mine] [partition=...] [state=...] - Просмотр очереди задач.\n"
                     "/cancel_job - Отменить задачу.\n"
                     "/add_monitoring - Начать мониторинг файла по установленному пути.\n"
                     "/stop_monitoring - Остановить мониторинг файла.\n"
@@ -202,17 +221,47 @@ def setup_handlers(router: Router):
         if user_id not in user_ssh_clients:
             await message.answer("Сначала подключитесь к серверу.")
             return
-        if user_id in monitoring_tasks:
-            task = monitoring_tasks[user_id]
-            task.cancel()
-            del monitoring_tasks[user_id]
+        stop_user_monitoring(user_id)
         if user_id in user_ssh_clients:
-            user_ssh_clients[user_id].close()
-            del user_ssh_clients[user_id]
+            await connections.disconnect(user_id)
             await message.answer("Отключение от сервера выполнено.")
         else:
             await message.answer("Соединение не установлено.")
 
+    @router.message(Command(commands=['status']))
+    async def connection_status(message: types.Message):
+        health = connections.connection_health(message.from_user.id)
+        if health is None:
+            await message.answer("Сначала подключитесь к серверу.")
+            return
+        latency = f"{health['latency'] * 1000:.0f} мс" if health['latency'] is not None else "нет данных"
+        text = (f"Сервер: {health['host']}\n"
+                f"Соединение: {'активно' if health['active'] else 'переподключение'}\n"
+                f"Задержка: {latency}\n"
+                f"Переподключений: {health['reconnects']}\n"
+                f"Пользователей на соединении: {health['users']}")
+        if health['last_error']:
+            text += f"\nПоследняя ошибка: {health['last_error']}"
+        cache = rendering.render_cache_stats()
+        text += (f"\nКэш графиков: попаданий {cache['hits'] + cache['shared']}, промахов {cache['misses']}, "
+                 f"{cache['entries']} изображений ({cache['bytes'] / 2 ** 20:.1f} МБ)")
+        for task_id, task in monitoring_tasks.get(message.from_user.id, {}).items():
+            updates = "по событиям" if task.watched else "опрос"
+            text += (f"\nМониторинг {task_id} ({task.file_path}): история {task.memory() / 2 ** 20:.1f} МБ, "
+                     f"обновления: {updates}")
+        await message.answer(text)
+
+    @router.message(Command(commands=['stats']))
+    async def show_stats(message: types.Message):
+        if message.from_user.id not in ADMIN_IDS:
+            await message.answer("Команда доступна только администраторам.")
+            return
+        text = instrumentation.format_stats()
+        if len(text) > 4000:
+            await message.answer_document(BufferedInputFile(text.encode('utf-8'), filename='stats.txt'))
+        else:
+            await message.answer(text)
+
     @router.message(Command(commands=['add_monitoring']))
     async def set_monitoring_path(message: types.Message, state: FSMContext):
         user_id = message.from_user.id
@@ -220,30 +269,49 @@ def setup_handlers(router: Router):
             await message.answer("Сначала подключитесь к серверу.")
             return
         await state.set_state(CommandState.setting_monitoring_path)
-        await message.answer("Пожалуйста, введите полный путь к файлу для мониторинга:")
+        await message.answer("Пожалуйста, введите полный путь к файлу для мониторинга "
+                             "и, при желании, интервал проверки в секундах: path [interval]. "
+                             "Папка или шаблон (/scratch/sweep/*.csv) выводит все запуски на общих графиках.")
 
     @router.message(CommandState.setting_monitoring_path)
     async def process_monitoring_path(message: types.Message, state: FSMContext):
-        SUPPORTED_FORMATS = ['.csv', '.json', '.log', '.txt']
-        monitoring_path = message.text
-        user_id = message.from_user.id
+        monitoring_path = message.text.strip()
+        monitoring_interval = MONITOR_INTERVAL
+        parts = monitoring_path.rsplit(maxsplit=1)
+        if len(parts) == 2 and parts[1].isdigit():
+            monitoring_path = parts[0]
+            monitoring_interval = max(int(parts[1]), MONITOR_TICK)
+        await select_monitoring_path(message, state, message.from_user.id, monitoring_path, monitoring_interval)
+
+    async def select_monitoring_path(message, state, user_id, monitoring_path, monitoring_interval):
         if user_id not in saved_connection_details:
             saved_connection_details[user_id] = {}
-        saved_connection_details[user_id]['monitoring_path'] = monitoring_path
+        metrics_path = monitoring_path
 
         file_extension = os.path.splitext(monitoring_path)[1]
-        if file_extension.lower() not in SUPPORTED_FORMATS:
-            await message.answer(
-                "Формат файла не поддерживается, поддерживаемые форматы: " + ', '.join(SUPPORTED_FORMATS))
-        else:
-            await state.clear()
-            await message.answer(
-                f"Путь для мониторинга установлен: {monitoring_path}")
-            metrics = get_metrics(user_id, monitoring_path, bot, user_ssh_clients)
-            await state.update_data(available_metrics=metrics)
-            await message.answer(
-                f"Доступные метрики: {', '.join(metrics)}\nВведите метрики, которые вы хотите отобразить, разделенные запятыми (например, 'Value1, Value2').")
-            await state.set_state(CommandState.awaiting_metric_selection)
+        if is_run_pattern(monitoring_path) or file_extension.lower() not in MONITOR_FORMATS:
+            # A directory or a glob: the metrics are taken from the most recent matching file
+            try:
+                monitoring_path, runs = await async_ssh.run_blocking(
+                    resolve_runs, user_id, user_ssh_clients[user_id], monitoring_path)
+            except Exception:
+                await message.answer("Папка не найдена или формат файла не поддерживается, "
+                                     "поддерживаемые форматы: " + ', '.join(MONITOR_FORMATS))
+                return
+            if not runs:
+                await message.answer(f"Не найдено файлов метрик по пути {monitoring_path}.")
+                return
+            metrics_path = max(runs, key=lambda path: runs[path].st_mtime or 0)
+        saved_connection_details[user_id]['monitoring_path'] = monitoring_path
+        saved_connection_details[user_id]['monitoring_interval'] = monitoring_interval
+        await state.clear()
+        await message.answer(
+            f"Путь для мониторинга установлен: {monitoring_path}")
+        metrics = await get_metrics(user_id, metrics_path, bot, user_ssh_clients)
+        await state.update_data(available_metrics=metrics)
+        await message.answer(
+            f"Доступные метрики: {', '.join(metrics)}\nВведите метрики, которые вы хотите отобразить, разделенные запятыми (например, 'Value1, Value2').")
+        await state.set_state(CommandState.awaiting_metric_selection)
 
 
     @router.message(CommandState.awaiting_metric_selection)
@@ -280,12 +348,11 @@ def setup_handlers(router: Router):
         monitoring_path = saved_connection_details[user_id]['monitoring_path']
         await callback_query.message.edit_text("Настройка графика завершена.")
         metrics = user_data.get('plot_configurations', [])
-        task = asyncio.create_task(monitor_file(user_id, monitoring_path, bot, user_ssh_clients, metrics))
-        task_id = id(task)
-        if user_id not in monitoring_tasks.keys():
-            monitoring_tasks[user_id] = {}
-        monitoring_tasks[user_id][task_id] = task
-        await bot.send_message(user_id, f"Мониторинг начат для файла {monitoring_path}. ID задачи: {task_id}")
+        monitoring_interval = saved_connection_details[user_id].get('monitoring_interval', MONITOR_INTERVAL)
+        task = start_monitoring(user_id, monitoring_path, bot, user_ssh_clients, metrics, monitoring_interval)
+        task_id = task.task_id
+        target = "файлов" if task.directory is not None else "файла"
+        await bot.send_message(user_id, f"Мониторинг начат для {target} {monitoring_path}. ID задачи: {task_id}")
 
     @router.message(Command(commands=['stop_monitoring']))
     async def stop_monitoring(message: types.Message):
@@ -304,7 +371,7 @@ def setup_handlers(router: Router):
     async def stop_selected_monitoring(callback_query: CallbackQuery):
         task_id = int(callback_query.data.split('_')[1])
         user_id = callback_query.from_user.id
-        if task_id in monitoring_tasks[user_id]:
+        if task_id in monitoring_tasks.get(user_id, {}):
             monitoring_tasks[user_id][task_id].cancel()
             del monitoring_tasks[user_id][task_id]
             await callback_query.message.answer(f"Задача мониторинга {task_id} остановлена.")
@@ -315,9 +382,7 @@ def setup_handlers(router: Router):
     @router.callback_query(F.data.startswith('st_all'))
     async def stop_selected_monitoring(callback_query: CallbackQuery):
         user_id = callback_query.from_user.id
-        for task_id in monitoring_tasks[user_id]:
-            monitoring_tasks[user_id][task_id].cancel()
-            del monitoring_tasks[user_id][task_id]
+        stop_user_monitoring(user_id)
         await callback_query.message.answer(f"Задачи мониторинга остановлены.")
         await callback_query.message.edit_reply_markup()  # Optional: Remove the inline buttons
 
@@ -328,12 +393,13 @@ def setup_handlers(router: Router):
             await message.answer("Сначала подключитесь к серверу.")
             return
         ssh_client = user_ssh_clients[user_id]
-        job_id = message.text.split(' ')[1] if len(message.text.split(' ')) > 1 else None
-        if job_id:
-            response = await cancel_job(ssh_client, job_id)
+        job_spec = message.text.split(' ', 1)[1] if len(message.text.split(' ')) > 1 else None
+        if job_spec:
+            response = await cancel_job(ssh_client, job_spec)
             await message.answer(response)
         else:
-            await message.answer("Пожалуйста, укажите ID задачи. Формат: /cancel_job [job_id]")
+            await message.answer("Пожалуйста, укажите ID задачи. Формат: /cancel_job [job_id ...], "
+                                 "/cancel_job 100-120 или /cancel_job state=PENDING")
 
     @router.message(Command(commands=['show_queue']))
     async def show_queue_command(message: types.Message):
@@ -342,11 +408,23 @@ def setup_handlers(router: Router):
             await message.answer("Сначала подключитесь к серверу.")
             return
         ssh_client = user_ssh_clients[user_id]
-        response = await show_queue(ssh_client)
-        max_length = 4000
-        if len(response) > max_length:
-            response = response[:max_length] + "\n... (output truncated)"
-        await message.answer(response)
+        queue_filters[user_id] = parse_queue_filters(message.text.split()[1:])
+        response, page, pages = await show_queue(ssh_client, queue_filters[user_id])
+        await message.answer(response, reply_markup=queue_markup(page, pages))
+
+    @router.callback_query(F.data.startswith('queue_page_'))
+    async def show_queue_page(callback_query: CallbackQuery):
+        user_id = callback_query.from_user.id
+        if user_id not in user_ssh_clients:
+            await callback_query.answer("Сначала подключитесь к серверу.")
+            return
+        page = int(callback_query.data.split('_')[2])
+        response, page, pages = await show_queue(user_ssh_clients[user_id], queue_filters.get(user_id), page)
+        try:
+            await callback_query.message.edit_text(response, reply_markup=queue_markup(page, pages))
+        except Exception as e:
+            logging.error(f"Failed to show queue page: {e}")
+        await callback_query.answer()
 
     @router.message(CommandState.waiting_for_job)
     async def process_submit_job_command(message: types.Message, state: FSMContext):
@@ -354,8 +432,34 @@ def setup_handlers(router: Router):
         job_script_path = message.text
         user_id = message.from_user.id
         ssh_client = user_ssh_clients[user_id]
-        response = await submit_job(ssh_client, job_script_path)
+        response, job_ids = await submit_job(ssh_client, job_script_path)
         await message.answer(response)
+        if job_ids:
+            track_jobs(user_id, ssh_client, job_ids, bot)
+            await message.answer(f"Уведомлю об изменении состояния задачи {', '.join(job_ids)}.")
+
+    @router.callback_query(F.data.startswith('watch_log_'))
+    async def monitor_job_log(callback_query: CallbackQuery, state: FSMContext):
+        user_id = callback_query.from_user.id
+        if user_id not in user_ssh_clients:
+            await callback_query.answer("Сначала подключитесь к серверу.")
+            return
+        job_id = callback_query.data.split('_')[2]
+        await callback_query.answer()
+        await callback_query.message.edit_reply_markup()
+        log_path = await job_log_path(user_ssh_clients[user_id], job_id)
+        if log_path is None:
+            await state.set_state(CommandState.setting_monitoring_path)
+            await callback_query.message.answer(
+                f"Не удалось определить лог задачи {job_id}. Введите полный путь к файлу для мониторинга:")
+            return
+        if os.path.splitext(log_path)[1].lower() not in MONITOR_FORMATS:
+            # Not a directory either, resolving it as one would only report a missing folder
+            await callback_query.message.answer(
+                f"Лог задачи {job_id} ({log_path}) нельзя мониторить, поддерживаемые форматы: "
+                + ', '.join(MONITOR_FORMATS))
+            return
+        await select_monitoring_path(callback_query.message, state, user_id, log_path, MONITOR_INTERVAL)
 
     @router.message(Command(commands=['submit_job']))
     async def submit_job_command(message: types.Message, state: FSMContext):
@@ -365,7 +469,8 @@ def setup_handlers(router: Router):
             return
         ssh_client = user_ssh_clients[user_id]
         await state.set_state(CommandState.waiting_for_job)
-        await message.answer("Введите путь к скрипту задачи на сервере:")
+        await message.answer("Введите путь к скрипту задачи на сервере (можно несколько путей, шаблон вида "
+                             "jobs/*.sh и --array=0-9):")
 
     @router.message(CommandState.waiting_for_download_filename)
     async def process_download_file_command(message: types.Message, state: FSMContext):
@@ -378,7 +483,13 @@ def setup_handlers(router: Router):
         user_id = message.from_user.id
 
         ssh_client = user_ssh_clients[user_id]
-        response = await download_file(ssh_client, remote_file_path, local_file_path)
+        status = await message.answer("Скачивание файла...")
+        progress = new_progress()
+        reporter = asyncio.create_task(report_progress(status, progress, "Скачивание"))
+        try:
+            response = await download_file(ssh_client, remote_file_path, local_file_path, progress)
+        finally:
+            reporter.cancel()
         if "успешно" in response:
             document = FSInputFile(local_file_path)
             await bot.send_document(message.from_user.id, document=document)
@@ -437,7 +548,13 @@ def setup_handlers(router: Router):
                 ssh_client = user_ssh_clients[user_id]
                 logging.info(f"File {file_name} exists, ready to upload.")
                 remote_path = f'{file_name}'  # Modify as needed
-                response = await upload_file(ssh_client, file_path, remote_path)
+                status = await message.answer("Загрузка файла на сервер...")
+                progress = new_progress()
+                reporter = asyncio.create_task(report_progress(status, progress, "Загрузка"))
+                try:
+                    response = await upload_file(ssh_client, file_path, remote_path, progress)
+                finally:
+                    reporter.cancel()
                 logging.info(f"File uploaded to remote server at path: {remote_path}")
             else:
                 response = f"Ошибка: Файл {file_name} не найден локально после загрузки."
@@ -468,14 +585,14 @@ def setup_handlers(router: Router):
 
         command = message.text
         await state.clear()
+        user_id = message.from_user.id
+        ssh_client = user_ssh_clients[user_id]
+        await stream_command(message, ssh_client, command)
 
-        try:
-            user_id = message.from_user.id
-            ssh_client = user_ssh_clients[user_id]
-            stdin, stdout, stderr = ssh_client.exec_command(command)
-            output = stdout.read().decode('utf-8').strip()
-            error = stderr.read().decode('utf-8').strip()
-            response = output or error or "Нет вывода"
-            await message.answer(response)
-        except Exception as e:
-            await message.answer(f"Ошибка выполнения команды: {e}")
+    @router.callback_query(F.data.startswith('cancel_exec_'))
+    async def cancel_execute_command(callback_query: CallbackQuery):
+        run_id = int(callback_query.data.split('_')[2])
+        if cancel_command(run_id, callback_query.from_user.id):
+            await callback_query.answer("Команда отменяется...")
+        else:
+            await callback_query.answer("Команда уже завершена.")
@@ -0,0 +1,145 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from config import STATS_WINDOW, METRICS_LISTEN, METRICS_PORT
+
+PREFIX = 'loggerbot'
+QUANTILES = [0.5, 0.95, 0.99]
+
+spans = {}  # name -> {'count': ..., 'sum': ..., 'errors': ..., 'recent': deque of the last STATS_WINDOW durations}
+counters = {}  # name -> total
+gauges = {}  # name -> function returning a number or {label: number}
+stats_lock = threading.Lock()  # Spans also finish in the SSH thread pool
+metrics_runner = None
+
+
+def record(name, duration, failed=False):
+    with stats_lock:
+        stat = spans.get(name)
+        if stat is None:
+            stat = spans[name] = {'count': 0, 'sum': 0.0, 'errors': 0, 'recent': deque(maxlen=STATS_WINDOW)}
+        stat['count'] += 1
+        stat['sum'] += duration
+        stat['errors'] += failed
+        stat['recent'].append(duration)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record(name, time.perf_counter() - start, failed)
+
+
+def count(name, value=1):
+    with stats_lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def register_gauge(name, function):
+    gauges[name] = function
+
+
+def quantiles(values):
+    values = sorted(values)
+    if not values:
+        return [0.0 for _ in QUANTILES]
+    return [values[min(int(q * len(values)), len(values) - 1)] for q in QUANTILES]
+
+
+def snapshot():
+    with stats_lock:
+        span_values = {name: (stat['count'], stat['sum'], stat['errors'], list(stat['recent']))
+                       for name, stat in spans.items()}
+        counter_values = dict(counters)
+    gauge_values = {}
+    for name, function in gauges.items():
+        try:
+            gauge_values[name] = function()
+        except Exception as e:
+            logging.error(f"Failed to read gauge {name}: {e}")
+    return span_values, counter_values, gauge_values
+
+
+def render_prometheus():
+    span_values, counter_values, gauge_values = snapshot()
+    lines = [f"# TYPE {PREFIX}_span_seconds summary"]
+    for name, (total, seconds, errors, recent) in sorted(span_values.items()):
+        for q, value in zip(QUANTILES, quantiles(recent)):
+            lines.append(f'{PREFIX}_span_seconds{{span="{name}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'{PREFIX}_span_seconds_sum{{span="{name}"}} {seconds:.6f}')
+        lines.append(f'{PREFIX}_span_seconds_count{{span="{name}"}} {total}')
+    lines.append(f"# TYPE {PREFIX}_span_errors_total counter")
+    for name, (total, seconds, errors, recent) in sorted(span_values.items()):
+        lines.append(f'{PREFIX}_span_errors_total{{span="{name}"}} {errors}')
+    for name, value in sorted(counter_values.items()):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total {value}")
+    for name, value in sorted(gauge_values.items()):
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        if isinstance(value, dict):
+            for label, item in sorted(value.items(), key=lambda item: str(item[0])):
+                lines.append(f'{PREFIX}_{name}{{key="{label}"}} {item}')
+        else:
+            lines.append(f"{PREFIX}_{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def format_stats():
+    span_values, counter_values, gauge_values = snapshot()
+    lines = ["Задержки (p50 / p95 / p99, мс):"]
+    for name, (total, seconds, errors, recent) in sorted(span_values.items()):
+        p50, p95, p99 = (value * 1000 for value in quantiles(recent))
+        failed = f", ошибок {errors}" if errors else ''
+        lines.append(f"{name}: {p50:.0f} / {p95:.0f} / {p99:.0f} ({total} раз{failed})")
+    if counter_values:
+        lines.append("\nСчётчики:")
+        lines.extend(f"{name}: {value}" for name, value in sorted(counter_values.items()))
+    if gauge_values:
+        lines.append("\nТекущие значения:")
+        for name, value in sorted(gauge_values.items()):
+            if isinstance(value, dict):
+                value = ', '.join(f"{label}: {item}" for label, item in value.items()) or '0'
+            lines.append(f"{name}: {value}")
+    return '\n'.join(lines)
+
+
+async def dispatch_middleware(handler, event, data):
+    # Outer middleware of the dispatcher: times every update from arrival to the end of its handler
+    with span(f"update_{event.event_type}"):
+        return await handler(event, data)
+
+
+async def metrics_handler(request):
+    return web.Response(text=render_prometheus(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(shard=0):
+    # Each worker process serves its own numbers, on METRICS_PORT + its shard
+    global metrics_runner
+    if not METRICS_PORT or metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_LISTEN, METRICS_PORT + shard).start()
+    logging.info(f"Serving metrics on {METRICS_LISTEN}:{METRICS_PORT + shard}/metrics")
+
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import re
+from functools import partial
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import user_ssh_clients
+from config import JOB_WATCH_INTERVAL
+from functions import send_queue
+from functions.async_ssh import exec_command
+from functions.instrumentation import register_gauge
+from functions.scheduler_interface import cluster_key
+
+NOTIFY_STATES = ['RUNNING', 'COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED', 'OUT_OF_MEMORY', 'NODE_FAIL']
+FINAL_STATES = ['COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED',
+                'BOOT_FAIL', 'DEADLINE', 'FINISHED']
+STATE_NAMES = {
+    'RUNNING': "запущена",
+    'COMPLETED': "успешно завершена",
+    'FAILED': "завершилась с ошибкой",
+    'TIMEOUT': "превысила лимит времени",
+    'CANCELLED': "отменена",
+    'OUT_OF_MEMORY': "превысила лимит памяти",
+    'NODE_FAIL': "прервана из-за сбоя узла",
+    'FINISHED': "завершена",
+}
+
+JOB_ID = re.compile(r'\d+')  # Only plain ids reach the sacct/squeue/scontrol command line
+
+tracked_jobs = {}  # cluster -> {job_id: {'user_id': ..., 'state': ...}}
+cluster_clients = {}  # cluster -> {user_id: ssh client the user's jobs were submitted over}
+watcher_task = None
+register_gauge('tracked_jobs', lambda: sum(len(jobs) for jobs in tracked_jobs.values()))
+
+
+def reduce_states(states):
+    # Array tasks and heterogeneous components report separately; the job as a
+    # whole is running while any part runs and finished once all parts are
+    if any(state == 'RUNNING' for state in states):
+        return 'RUNNING'
+    if states and all(state in FINAL_STATES for state in states):
+        for state in ['FAILED', 'OUT_OF_MEMORY', 'NODE_FAIL', 'TIMEOUT', 'CANCELLED']:
+            if state in states:
+                return state
+        return 'COMPLETED'
+    return states[0] if states else None
+
+
+def parse_states(output):
+    states = {}
+    for line in output.splitlines():
+        parts = line.strip().split('|')
+        if len(parts) < 2 or not parts[1]:
+            continue
+        job_id = re.split(r'[_+.]', parts[0])[0]
+        states.setdefault(job_id, []).append(parts[1].split()[0])
+    return {job_id: reduce_states(values) for job_id, values in states.items()}
+
+
+async def query_states(ssh_client, job_ids):
+    # One sacct call for every tracked job of a cluster; squeue if accounting is off.
+    # None when neither could answer, the states are then asked again next interval.
+    ids = ','.join(job_id for job_id in job_ids if JOB_ID.fullmatch(job_id))
+    if not ids:
+        return {}
+    output, error = await exec_command(ssh_client, f"sacct -X -n -P -j {ids} --format=JobID,State")
+    if output or not error:
+        return parse_states(output)
+    output, error = await exec_command(ssh_client, f"squeue -h -j {ids} -o '%i|%T'")
+    if error and 'Invalid job id' not in error:
+        logging.error(f"Job states unavailable, sacct and squeue failed: {error}")
+        return None
+    states = parse_states(output)
+    # Jobs that left the queue are over, squeue cannot tell how they ended
+    return {job_id: states.get(job_id, 'FINISHED') for job_id in job_ids}
+
+
+def monitoring_markup(job_id):
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Мониторить лог", callback_data=f"watch_log_{job_id}")]])
+
+
+async def check_cluster(key, bot):
+    # One batched query per cluster connection, the states go to the owner of each job.
+    # Users of the same account share a connection; another account is queried over its
+    # own, since it may not see the jobs (Slurm PrivateData) and may disconnect separately
+    jobs = tracked_jobs.get(key)
+    if not jobs:
+        return
+    owners = {}
+    for job_id, job in jobs.items():
+        owners.setdefault(job['user_id'], []).append(job_id)
+    clients = cluster_clients.get(key, {})
+    connections = {}  # transport -> (ssh client, job ids of every user on it)
+    for user_id, job_ids in owners.items():
+        ssh_client = owner_client(key, user_id, clients.get(user_id))
+        if ssh_client is not None:
+            connections.setdefault(ssh_client.get_transport(), (ssh_client, []))[1].extend(job_ids)
+    for ssh_client, job_ids in connections.values():
+        try:
+            await check_jobs(jobs, ssh_client, job_ids, bot)
+        except Exception as e:
+            logging.error(f"Failed to check jobs {', '.join(job_ids)} on {key}: {e}")
+    for user_id in list(clients):
+        if user_id not in owners:
+            del clients[user_id]
+    if not jobs:
+        tracked_jobs.pop(key, None)
+        cluster_clients.pop(key, None)
+
+
+def owner_client(key, user_id, submitted_with):
+    # The connection the jobs were submitted over, or the user's current one after a reconnect
+    for ssh_client in (submitted_with, user_ssh_clients.get(user_id)):
+        transport = ssh_client.get_transport() if ssh_client is not None else None
+        if transport is not None and transport.is_active() and transport.getpeername() == key:
+            return ssh_client
+    return None
+
+
+async def check_jobs(jobs, ssh_client, job_ids, bot):
+    states = await query_states(ssh_client, job_ids)
+    if states is None:
+        return
+    for job_id, state in states.items():
+        job = jobs.get(job_id)
+        if job is None or state is None or state == job['state']:
+            continue
+        job['state'] = state
+        if state in NOTIFY_STATES or state == 'FINISHED':
+            markup = monitoring_markup(job_id) if state == 'RUNNING' else None
+            text = f"Задача {job_id} {STATE_NAMES.get(state, state)}."
+            send_queue.enqueue(job['user_id'], partial(bot.send_message, job['user_id'], text, reply_markup=markup))
+        if state in FINAL_STATES:
+            del jobs[job_id]
+
+
+async def watch_jobs(bot):
+    while tracked_jobs:
+        await asyncio.sleep(JOB_WATCH_INTERVAL)
+        for key in list(tracked_jobs):
+            try:
+                await check_cluster(key, bot)
+            except Exception as e:
+                logging.error(f"Failed to check jobs on {key}: {e}")
+
+
+def track_jobs(user_id, ssh_client, job_ids, bot):
+    global watcher_task
+    key = cluster_key(ssh_client)
+    jobs = tracked_jobs.setdefault(key, {})
+    for job_id in job_ids:
+        jobs[job_id] = {'user_id': user_id, 'state': None}
+    cluster_clients.setdefault(key, {})[user_id] = ssh_client
+    if watcher_task is None or watcher_task.done():
+        watcher_task = asyncio.create_task(watch_jobs(bot))
+
+
+async def job_log_path(ssh_client, job_id):
+    # The id comes from callback data, only a plain one reaches the shell
+    if not JOB_ID.fullmatch(job_id):
+        return None
+    output, error = await exec_command(ssh_client, f"scontrol show job -o {job_id}")
+    match = re.search(r'\bStdOut=(\S+)', output)
+    return match.group(1) if match else None
@@ -1,35 +1,76 @@
-import pandas as pd
 import json
 import logging
 import os
+import re
+from io import StringIO
 
-def ensure_directory_exists(path):
-    os.makedirs(path, exist_ok=True)
+from config import METRICS_PREFIX_BYTES, METRICS_SCHEMA_CACHE_SIZE
+from functions.async_ssh import run_blocking
+from functions.monitor import get_sftp
 
-def get_metrics(user_id, file_path, bot, ssh_clients):
+schema_cache = {}  # (host, path, size, mtime) -> list of metric names
+EPOCH = re.compile(r'[-+]?\d+')
+
+
+async def get_metrics(user_id, file_path, bot, ssh_clients):
     ssh_client = ssh_clients.get(user_id)
     if not ssh_client:
         logging.error("SSH client not available for user_id {}".format(user_id))
         return  # Handle error or disconnected state
-    sftp = ssh_client.open_sftp()
+    return await run_blocking(read_metrics, ssh_client, user_id, file_path)
+
+def read_metrics(ssh_client, user_id, file_path):
+    sftp = get_sftp(user_id, ssh_client)
     attrs = sftp.stat(file_path)
-    local_path = f"./tmp/{user_id}_temp.csv"
-    ensure_directory_exists('./tmp/')
-    sftp.get(file_path, local_path)
-    extension = local_path.split('.')[-1].lower()
-    if extension == 'csv':
-        df = pd.read_csv(local_path)
-        return df.columns.tolist()
-    elif extension == 'json':
-        with open(local_path, 'r') as file:
-            data = json.load(file)
-            if isinstance(data, list):
-                return list(data[0].keys())
-            else:
-                return list(data.keys())
-    elif extension in ['log', 'txt']:
-        with open(local_path, 'r') as file:
-            first_line = file.readline()
-            return first_line.strip().split()[2:]
+    key = (ssh_client.get_transport().getpeername(), file_path, attrs.st_size, attrs.st_mtime)
+    if key in schema_cache:
+        return schema_cache[key]
+    extension = os.path.splitext(file_path)[-1].lower()
+    with sftp.open(file_path, 'rb') as remote_file:
+        metrics = read_schema(remote_file, extension, attrs.st_size)
+    if len(schema_cache) >= METRICS_SCHEMA_CACHE_SIZE:
+        del schema_cache[next(iter(schema_cache))]
+    schema_cache[key] = metrics
+    return metrics
+
+def read_schema(remote_file, extension, size):
+    # Reads a growing prefix of the file until the header or first record is complete
+    limit = min(METRICS_PREFIX_BYTES, size)
+    data = remote_file.read(limit)
+    while True:
+        metrics = parse_schema(data.decode('utf-8', errors='ignore'), extension, len(data) >= size)
+        if metrics is not None:
+            return metrics
+        more = remote_file.read(len(data))
+        if not more:
+            raise ValueError("Не удалось определить метрики файла")
+        data += more
+
+def parse_schema(text, extension, complete):
+    if extension == '.csv':
+        if '\n' not in text and not complete:
+            return None
+        import pandas as pd
+        return pd.read_csv(StringIO(text.split('\n', 1)[0]), nrows=0).columns.tolist()
+    elif extension in ['.json', '.jsonl', '.ndjson']:
+        # Only the first value is decoded: a record of an array or of JSON Lines, or an object of columns
+        stripped = text.lstrip()
+        if stripped.startswith('['):
+            stripped = stripped[1:].lstrip()
+        try:
+            record, _ = json.JSONDecoder().raw_decode(stripped)
+        except json.JSONDecodeError:
+            return None
+        return list(record.keys())
+    elif extension in ['.log', '.txt', '.out', '.err']:
+        # Keys of the first "Epoch N key value ..." line, whatever banner comes before it
+        lines = text.split('\n')
+        if not complete:
+            lines = lines[:-1]
+        for line in lines:
+            tokens = line.split()
+            if len(tokens) > 1 and EPOCH.fullmatch(tokens[1]):
+                return tokens[2::2]
+        return [] if complete else None
     else:
         raise ValueError("Неподдерживаемый формат файла")
@@ -1,57 +1,502 @@
 import time
 
-from aiogram.types import InputFile, BufferedInputFile
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InputFile, BufferedInputFile, InputMediaPhoto
 import logging
 from io import BytesIO
-import pandas as pd
-import matplotlib.pyplot as plt
 import asyncio
+import fnmatch
+import itertools
 import os
-from functions import plotting
+import random
+import re
+import stat
+from functools import partial
+from functions import rendering, send_queue, save_load_data, file_watcher
+from functions.series_store import SeriesStore
+from functions.instrumentation import span, count, register_gauge
+from functions.async_ssh import run_blocking
+from functions.remote_aggregation import fetch_aggregated
+from config import monitoring_tasks, user_ssh_clients
+from config import (TRANSFER_TIMEOUT, MONITOR_INTERVAL, MONITOR_TICK, MONITOR_IDLE_BACKOFF, MONITOR_MAX_IDLE_FACTOR,
+                    MONITOR_MAX_ERROR_DELAY, MONITOR_JITTER, MONITOR_MAX_RUNS, MONITOR_READ_BLOCK,
+                    MONITOR_WATCH, MONITOR_WATCH_DEBOUNCE, MONITOR_WATCH_RECHECK, TRANSFER_BLOCK_SIZE,
+                    REMOTE_AGGREGATION)
 
-def ensure_directory_exists(path):
-    os.makedirs(path, exist_ok=True)
+HEAD_BYTES = 256  # Prefix compared on every read to notice a rewritten or rotated file
+MONITOR_FORMATS = ['.csv', '.json', '.jsonl', '.ndjson', '.log', '.txt', '.out', '.err']  # .out/.err: Slurm job output
+GLOB_CHARS = re.compile(r'[*?\[]')
 
-async def monitor_file(user_id, file_path, bot, ssh_clients, metrics):
-    ssh_client = ssh_clients.get(user_id)
-    if not ssh_client:
-        logging.error("SSH client not available for user_id {}".format(user_id))
-        return  # Handle error or disconnected state
+task_ids = itertools.count(1)
 
-    last_modified = None
-    last_message_id = None
-    while True:
+
+def metric_columns(metrics):
+    return list(dict.fromkeys(metric for group in metrics for metric in group))
+
+
+def new_tail_state(metrics):
+    # 'series' keeps only the plotted metrics of the file, within MONITOR_TASK_MEMORY
+    return {'offset': 0, 'head': b'', 'columns': None, 'metrics': metric_columns(metrics), 'series': None}
+
+
+def new_run(metrics):
+    return {'state': new_tail_state(metrics), 'last_modified': None, 'last_size': None}
+
+
+def is_run_pattern(file_path):
+    # Only the last path component may hold glob characters: /scratch/sweep/*.csv
+    return bool(GLOB_CHARS.search(os.path.basename(file_path)))
+
+
+def match_runs(file_path, entries):
+    # Metrics files of a directory listing that match the pattern, {path: attrs},
+    # at most MONITOR_MAX_RUNS of them, the most recently changed ones
+    directory, pattern = os.path.split(file_path)
+    runs = {os.path.join(directory, attrs.filename): attrs for attrs in entries
+            if stat.S_ISREG(attrs.st_mode or 0) and fnmatch.fnmatchcase(attrs.filename, pattern)
+            and os.path.splitext(attrs.filename)[1].lower() in MONITOR_FORMATS}
+    if len(runs) > MONITOR_MAX_RUNS:
+        newest = sorted(runs, key=lambda path: runs[path].st_mtime or 0, reverse=True)[:MONITOR_MAX_RUNS]
+        runs = {path: runs[path] for path in newest}
+    return dict(sorted(runs.items()))
+
+
+def resolve_runs(user_id, ssh_client, file_path):
+    # A directory stands for every metrics file in it. Returns the glob the task
+    # watches and the files it currently matches.
+    if not is_run_pattern(file_path):
+        file_path = os.path.join(file_path.rstrip('/') or '/', '*')
+    sftp = get_sftp(user_id, ssh_client)
+    return file_path, match_runs(file_path, sftp.listdir_attr(os.path.dirname(file_path)))
+
+
+def file_changed(record, attrs):
+    return (record['last_modified'] is None or attrs.st_mtime > record['last_modified']
+            or attrs.st_size != record['last_size'])
+
+
+def read_range(remote_file, start, end):
+    chunks = [(offset, min(TRANSFER_BLOCK_SIZE, end - offset)) for offset in range(start, end, TRANSFER_BLOCK_SIZE)]
+    with span('monitor_download'):
+        data = b''.join(remote_file.readv(chunks))
+    count('monitor_bytes', len(data))
+    return data
+
+
+def read_lines(remote_file, file_ext, size, state):
+    # Downloads the file from state['offset'] in MONITOR_READ_BLOCK pieces and
+    # parses the complete lines or JSON records of each into the series, so neither
+    # the text nor a DataFrame of the whole file is ever held. What is left of a
+    # half-written record is read again next time. Returns the number of new rows.
+    from functions import plotting
+    rows = 0
+    rest = b''
+    position = state['offset']
+    while position < size:
+        # A record longer than a block makes the next read larger rather than reparsing it every block
+        block = read_range(remote_file, position, min(position + max(MONITOR_READ_BLOCK, len(rest)), size))
+        if not block:
+            break
+        position += len(block)
+        if len(state['head']) < HEAD_BYTES:
+            state['head'] = (state['head'] + block)[:HEAD_BYTES]
+        data = rest + block
+        # Records of a JSON array end with '}', which, like '\n', never splits a UTF-8 character
+        end = data.rfind(b'}' if file_ext == '.json' else b'\n') + 1
+        if end == 0:
+            # No complete line yet
+            rest = data
+            continue
+        with span('monitor_parse'):
+            text = data[:end].decode('utf-8')
+            if file_ext in plotting.JSON_FORMATS:
+                df, consumed = plotting.parse_json_text(text, file_ext)
+                if consumed < len(text):
+                    end = len(text[:consumed].encode('utf-8'))
+            else:
+                df = plotting.parse_text(text, file_ext, state['columns'])
+            if file_ext == '.csv' and state['columns'] is None:
+                state['columns'] = df.columns.tolist()
+            state['series'].append(df)
+        rest = data[end:]
+        rows += len(df)
+    state['offset'] = position - len(rest)
+    return rows
+
+
+def read_full(remote_file, file_ext, size, state):
+    state.update(offset=0, head=b'', columns=None, series=SeriesStore(state['metrics']))
+    read_lines(remote_file, file_ext, size, state)
+
+
+def whole_document(file_ext, state):
+    # JSON that is not an array of records (e.g. one object of columns) is rewritten
+    # rather than appended to, so it is read again in full on every change
+    return file_ext == '.json' and not state['head'].lstrip().startswith(b'[')
+
+
+def read_appended(sftp, file_path, attrs, state):
+    # Reads only the bytes appended since the last call and adds the new rows to
+    # state['series']. Falls back to one full read when the file was truncated
+    # or replaced. Returns True when the data changed.
+    file_ext = os.path.splitext(file_path)[-1].lower()
+    size = attrs.st_size
+    with sftp.open(file_path, 'rb') as remote_file:
+        resync = state['series'] is None or size < state['offset'] or whole_document(file_ext, state)
+        if not resync and state['head']:
+            remote_file.seek(0)
+            resync = remote_file.read(len(state['head'])) != state['head']
+        if resync:
+            previous = dict(state)
+            if previous['series'] is not None and not whole_document(file_ext, state):
+                logging.info(f"File {file_path} was truncated or replaced, reading it again")
+            read_full(remote_file, file_ext, size, state)
+            if not state['series'].length and previous['series'] is not None and previous['series'].length:
+                # Caught in the middle of being rewritten, the last complete version stays
+                state.update(previous)
+                return False
+            return True
+        if size == state['offset']:
+            return False
+        return read_lines(remote_file, file_ext, size, state) > 0
+
+
+class MonitorTask:
+    def __init__(self, user_id, file_path, metrics, interval=MONITOR_INTERVAL, remote=REMOTE_AGGREGATION):
+        self.task_id = next(task_ids)
+        self.user_id = user_id
+        self.file_path = file_path
+        self.metrics = metrics
+        self.interval = interval
+        self.delay = interval
+        self.next_check = 0
+        self.errors = 0
+        self.last_modified = None
+        self.last_size = None
+        self.last_message_id = None
+        self.last_png = None
+        self.state = new_tail_state(metrics)
+        self.remote = remote
+        self.cancelled = False
+        # A directory or glob task follows many files: one listdir_attr per check, the runs overlaid in one plot
+        self.directory = os.path.dirname(file_path) if is_run_pattern(file_path) else None
+        self.runs = {} if self.directory is not None else None  # path -> new_run()
+        self.watched = False  # Set while file_watcher reports changes, polling is then only a safety net
+        self.pending = False  # A change event arrived since the last check started
+        self.triggered = False  # The current check was started by a change event
+        self.events_missed = False  # A poll found a change no event reported, events are not relied on
+
+    def memory(self):
+        # Bytes of history this task keeps
+        states = [run['state'] for run in self.runs.values()] if self.runs is not None else [self.state]
+        return sum(state['series'].nbytes() for state in states if state['series'] is not None)
+
+    def watches(self, path):
+        # Whether a changed path reported by the file watcher is this task's file or one of its runs
+        if self.directory is None:
+            return path == os.path.normpath(self.file_path)
+        pattern = os.path.normpath(self.file_path)
+        return (os.path.dirname(path) == os.path.dirname(pattern)
+                and fnmatch.fnmatchcase(os.path.basename(path), os.path.basename(pattern)))
+
+    def notify(self, now, event=True):
+        # Events within MONITOR_WATCH_DEBOUNCE of the first one are served by a single read.
+        # Polling backs off only once an event for the file has actually arrived.
+        if event and not self.events_missed:
+            self.watched = True
+        self.pending = True
+        self.next_check = min(self.next_check, now + MONITOR_WATCH_DEBOUNCE)
+
+    def cancel(self):
+        self.cancelled = True
+        save_load_data.delete_monitoring(self.task_id)
+
+    def reschedule(self, now, changed):
+        # Unchanged files are polled less and less often, failing ones back off exponentially
+        if changed and self.watched and not self.triggered:
+            # Written where inotify cannot see it, e.g. from a compute node over NFS or Lustre
+            logging.info(f"Change of {self.file_path} was not reported by the file watcher, polling it again")
+            self.watched = False
+            self.events_missed = True
+        if self.errors:
+            self.delay = min(self.interval * 2 ** self.errors, MONITOR_MAX_ERROR_DELAY)
+        elif self.watched:
+            self.delay = MONITOR_WATCH_RECHECK
+        elif changed:
+            self.delay = self.interval
+        else:
+            self.delay = min(self.delay * MONITOR_IDLE_BACKOFF, self.interval * MONITOR_MAX_IDLE_FACTOR)
+        self.next_check = now + self.delay * random.uniform(1 - MONITOR_JITTER, 1 + MONITOR_JITTER)
+        if self.pending and not self.errors:
+            # Changed again while it was being read
+            self.next_check = min(self.next_check, now + MONITOR_WATCH_DEBOUNCE)
+
+
+sftp_sessions = {}  # user_id -> (Transport, SFTPClient), one long-lived channel per connection
+busy_connections = set()
+scheduler_task = None
+register_gauge('monitoring_tasks', lambda: {user_id: len(tasks) for user_id, tasks in monitoring_tasks.items()})
+register_gauge('sftp_sessions', lambda: len(sftp_sessions))
+register_gauge('monitor_memory_bytes', lambda: {task_id: task.memory() for tasks in monitoring_tasks.values()
+                                                for task_id, task in tasks.items()})
+
+
+def get_sftp(user_id, ssh_client):
+    # The session is bound to the transport, so a reconnect transparently gets a new one
+    transport = ssh_client.get_transport()
+    session = sftp_sessions.get(user_id)
+    if session is not None and session[0] is transport:
+        return session[1]
+    if session is not None:
+        close_sftp(user_id)
+    sftp = ssh_client.open_sftp()
+    sftp_sessions[user_id] = (transport, sftp)
+    return sftp
+
+
+def close_sftp(user_id):
+    session = sftp_sessions.pop(user_id, None)
+    if session is not None:
+        try:
+            session[1].close()
+        except Exception as e:
+            logging.error(f"Failed to close SFTP session for user_id {user_id}: {e}")
+
+
+def stat_files(user_id, ssh_client, file_paths, directories=()):
+    # All due files of one connection are checked in a single trip to the thread pool,
+    # directories of glob tasks with one listing each
+    sftp = get_sftp(user_id, ssh_client)
+    results = {}
+    for file_path in file_paths:
+        try:
+            results[file_path] = sftp.stat(file_path)
+        except Exception as e:
+            results[file_path] = e
+    for directory in directories:
+        try:
+            results[directory] = sftp.listdir_attr(directory)
+        except Exception as e:
+            results[directory] = e
+    return sftp, results
+
+
+def read_runs(sftp, changed):
+    # Reads the appended part of every changed run file; a failing file is retried on the next check
+    updated = False
+    for file_path, (run, attrs) in changed.items():
+        try:
+            updated = read_appended(sftp, file_path, attrs, run['state']) or updated
+        except Exception as e:
+            logging.error(f"Error reading run file {file_path}: {e}")
+            run['last_modified'] = None
+    return updated
+
+
+async def read_changes(task, sftp, attrs, ssh_client):
+    if task.remote:
+        # The remote host parses and reduces the file, only the result is transferred
+        with span('monitor_remote_aggregation'):
+            df = await fetch_aggregated(ssh_client, task.file_path, task.metrics)
+        if df is not None:
+            task.state['series'] = SeriesStore(task.state['metrics'])
+            task.state['series'].append(df)
+            return True
+        logging.info(f"Falling back to reading {task.file_path} directly")
+        task.remote = False
+        task.state = new_tail_state(task.metrics)
+    return await run_blocking(read_appended, sftp, task.file_path, attrs, task.state,
+                              timeout=TRANSFER_TIMEOUT, on_cancel=sftp.close)
+
+
+async def monitor_file(task, sftp, attrs, bot, ssh_client):
+    if not (task.last_modified is None or attrs.st_mtime > task.last_modified or attrs.st_size != task.last_size):
+        return False
+    # File has changed, update last_modified and read the appended part
+    task.last_modified = attrs.st_mtime
+    task.last_size = attrs.st_size
+    if not await read_changes(task, sftp, attrs, ssh_client):
+        return False
+    if task.cancelled:
+        return True
+    return await publish_plot(task, bot, task.state['series'].frame(), task.metrics)
+
+
+async def monitor_runs(task, sftp, entries, bot, ssh_client):
+    # entries is the listing of the task's directory: only new and changed files are read
+    from functions import plotting
+    found = match_runs(task.file_path, entries)
+    changed = {}
+    removed = [file_path for file_path in task.runs if file_path not in found]
+    for file_path in removed:
+        del task.runs[file_path]
+    for file_path, attrs in found.items():
+        run = task.runs.get(file_path)
+        if run is None:
+            run = task.runs[file_path] = new_run(task.metrics)
+        if file_changed(run, attrs):
+            run['last_modified'] = attrs.st_mtime
+            run['last_size'] = attrs.st_size
+            changed[file_path] = (run, attrs)
+    if changed:
+        updated = await run_blocking(read_runs, sftp, changed, timeout=TRANSFER_TIMEOUT, on_cancel=sftp.close)
+    else:
+        updated = False
+    if not (updated or removed) or task.cancelled:
+        return False
+    runs = {os.path.splitext(os.path.basename(file_path))[0]: run['state']['series'].frame()
+            for file_path, run in task.runs.items() if run['state']['series'] is not None}
+    df, metrics = plotting.overlay_runs(runs, task.metrics)
+    if df.empty:
+        return False
+    return await publish_plot(task, bot, df, metrics)
+
+
+async def publish_plot(task, bot, df, metrics):
+    # Plot and queue the update, a newer plot of this task replaces it while it waits
+    with span('monitor_render'):
+        png = await rendering.render_plot(df, metrics)
+    if png == task.last_png:
+        # Rewritten with the same content, the user already has this plot
+        return False
+    task.last_png = png
+    send_queue.enqueue(task.user_id, lambda: send_plot(bot, task, png), key=('plot', task.task_id))
+    return True
+
+
+async def send_plot(bot, task, png):
+    if task.cancelled:
+        return None
+    photo = BufferedInputFile(png, filename="plot.png")
+
+    # Replace the image of the last sent photo if it exists
+    if task.last_message_id:
+        try:
+            return await bot.edit_message_media(InputMediaPhoto(media=photo), chat_id=task.user_id,
+                                                message_id=task.last_message_id)
+        except TelegramRetryAfter:
+            raise
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                return None
+            logging.error(f"Failed to edit previous plot, sending a new one: {e}")
+
+    # Send new plot and store message ID
+    message = await bot.send_photo(task.user_id, photo=photo)
+    task.last_message_id = message.message_id
+    return message
+
+
+async def poll_connection(user_id, tasks, bot, ssh_clients):
+    loop = asyncio.get_running_loop()
+    for task in tasks:
+        task.triggered, task.pending = task.pending, False
+    try:
+        ssh_client = ssh_clients.get(user_id)
+        if not ssh_client:
+            # Not connected yet, e.g. monitoring resumed after a restart
+            for task in tasks:
+                task.reschedule(loop.time(), False)
+            return
+        transport = ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            # The connection manager is reconnecting, wait for it without logging every task
+            for task in tasks:
+                task.reschedule(loop.time(), False)
+            return
+        file_paths = list(dict.fromkeys(task.file_path for task in tasks if task.directory is None))
+        directories = list(dict.fromkeys(task.directory for task in tasks if task.directory is not None))
         try:
-            sftp = ssh_client.open_sftp()
-            attrs = sftp.stat(file_path)
-            if last_modified is None or attrs.st_mtime > last_modified:
-            # if True:
-                # File has changed, update last_modified and process file
-                last_modified = attrs.st_mtime
-                local_path = f"./tmp/{user_id}_temp.csv"
-                ensure_directory_exists('./tmp/')
-                sftp.get(file_path, local_path)
-
-                # Plot and prepare to send the file
-                buf = plotting.plot_and_send_file(local_path, metrics)
-                photo = BufferedInputFile(buf.getvalue(), filename="plot.png")
-
-                # Delete the last sent photo if it exists
-                if last_message_id:
-                    try:
-                        await bot.delete_message(user_id, last_message_id)
-                    except Exception as e:
-                        logging.error("Failed to delete previous message: {}".format(e))
-
-                # Send new plot and store message ID
-                message = await bot.send_photo(user_id, photo=photo)
-                last_message_id = message.message_id
-
-                buf.close()
-            sftp.close()
+            with span('monitor_stat'):
+                sftp, results = await run_blocking(stat_files, user_id, ssh_client, file_paths, directories)
         except Exception as e:
-            logging.error(f"Error monitoring file: {e}")
-            # Handle error and consider a cooldown or stop
+            logging.error(f"Error monitoring files of user_id {user_id}: {e}")
+            close_sftp(user_id)
+            for task in tasks:
+                task.errors += 1
+                task.reschedule(loop.time(), False)
+            return
+        for task in tasks:
+            if task.cancelled:
+                continue
+            changed = False
+            attrs = results[task.directory or task.file_path]
+            try:
+                if isinstance(attrs, Exception):
+                    raise attrs
+                with span('monitor_cycle'):
+                    if task.directory is not None:
+                        changed = await monitor_runs(task, sftp, attrs, bot, ssh_client)
+                    else:
+                        changed = await monitor_file(task, sftp, attrs, bot, ssh_client)
+                task.errors = 0
+            except Exception as e:
+                logging.error(f"Error monitoring file {task.file_path}: {e}")
+                task.errors += 1
+            task.reschedule(loop.time(), changed)
+    finally:
+        busy_connections.discard(user_id)
+
+
+async def run_scheduler(bot, ssh_clients):
+    loop = asyncio.get_running_loop()
+    while True:
+        now = loop.time()
+        due = {}
+        for user_id, tasks in monitoring_tasks.items():
+            if user_id in busy_connections:
+                continue
+            for task in tasks.values():
+                if not task.cancelled and task.next_check <= now:
+                    due.setdefault(user_id, []).append(task)
+        for user_id, tasks in due.items():
+            busy_connections.add(user_id)
+            asyncio.create_task(poll_connection(user_id, tasks, bot, ssh_clients))
+        for user_id in list(sftp_sessions):
+            if not monitoring_tasks.get(user_id) and user_id not in busy_connections:
+                close_sftp(user_id)
+        if MONITOR_WATCH:
+            file_watcher.sync_watchers(ssh_clients)
+        await asyncio.sleep(MONITOR_TICK)
+
+
+def start_monitoring(user_id, file_path, bot, ssh_clients, metrics, interval=MONITOR_INTERVAL):
+    global scheduler_task
+    task = MonitorTask(user_id, file_path, metrics, interval)
+    monitoring_tasks.setdefault(user_id, {})[task.task_id] = task
+    save_load_data.save_monitoring(task.task_id, user_id, file_path, metrics, interval)
+    if scheduler_task is None or scheduler_task.done():
+        scheduler_task = asyncio.create_task(run_scheduler(bot, ssh_clients))
+    return task
+
+
+async def resume_monitoring(bot, shard=0, shards=1):
+    # Monitoring saved before a restart starts again and picks the files up once the user reconnects.
+    # With several workers each one resumes the tasks of its own users.
+    global task_ids, scheduler_task
+    saved = save_load_data.load_monitoring()
+    # Ids stay unique across workers: every worker hands out the ones congruent to its shard
+    first_id = max([saved_task['task_id'] for saved_task in saved] + [0]) + 1
+    task_ids = itertools.count(first_id + (shard - first_id) % shards, shards)
+    saved = [saved_task for saved_task in saved if saved_task['user_id'] % shards == shard]
+    if not saved:
+        return
+    for saved_task in saved:
+        task = MonitorTask(saved_task['user_id'], saved_task['path'], saved_task['metrics'], saved_task['interval'])
+        task.task_id = saved_task['task_id']
+        monitoring_tasks.setdefault(task.user_id, {})[task.task_id] = task
+    scheduler_task = asyncio.create_task(run_scheduler(bot, user_ssh_clients))
+    for user_id, tasks in monitoring_tasks.items():
+        paths = ', '.join(task.file_path for task in tasks.values())
+        send_queue.enqueue(user_id, partial(bot.send_message, user_id,
+                                            f"Мониторинг возобновлён после перезапуска: {paths}. "
+                                            f"Подключитесь к серверу (/connect), чтобы получать графики."))
+    logging.info(f"Resumed {len(saved)} monitoring tasks")
+
 
-        await asyncio.sleep(30)  # Sleep for 1 minute before checking again
+def stop_monitoring(user_id):
+    for task in monitoring_tasks.pop(user_id, {}).values():
+        task.cancel()
+        send_queue.discard(('plot', task.task_id))
+    file_watcher.stop_watcher(user_id)
+    close_sftp(user_id)
@@ -1,14 +1,28 @@
+import csv
+import itertools
 import json
+import logging
 import os
 import math
+import re
 
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.io import to_image
-from io import BytesIO
+from io import BytesIO, StringIO
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.ticker import LogLocator
 
 from plotly.subplots import make_subplots
 
+from config import PLOT_MAX_POINTS, LOG_CHUNK_LINES, JSON_CHUNK_CHARS
+
+LOG_TICKS = 6  # Most major and minor ticks of a matplotlib log axis; every tick is laid out and drawn
+JSON_FORMATS = ['.json', '.jsonl', '.ndjson']
+JSON_SEPARATORS = re.compile(r'[\s,\[]*')  # What may come before a record of a JSON array or JSON Lines file
+
 
 def ensure_directory_exists(path):
     os.makedirs(path, exist_ok=True)
@@ -18,32 +32,242 @@ def read_data(file_path):
     file_ext = os.path.splitext(file_path)[-1].lower()
     if file_ext == ".csv":
         return pd.read_csv(file_path)
-    elif file_ext == ".json":
+    elif file_ext in JSON_FORMATS:
         with open(file_path, 'r') as file:
-            data = json.load(file)
-            return pd.DataFrame(data)
-    elif file_ext in [".log", ".txt"]:
-        data = []
+            return read_json(file, file_ext)
+    elif file_ext in [".log", ".txt", ".out", ".err"]:
         with open(file_path, 'r') as file:
-            for line in file:
-                elements = line.strip().split()
-                epoch = int(elements[1])  # Assuming 'Epoch' is always the first word and followed by the epoch number
-                values = elements[2:]  # Rest are values
-                # Process pairs of values
-                row = {'Epoch': epoch}
-                for i in range(0, len(values), 2):
-                    key = values[i]
-                    value = float(values[i + 1])
-                    row[key] = value
-                data.append(row)
-        df = pd.DataFrame(data)
+            return read_log(file)
+    else:
+        raise ValueError(f"Unsupported file type: {file_ext}")
+
+
+def read_log_tokens(text, width):
+    # Whitespace-separated tokens of every line, one column per token position.
+    # The width grows when the C parser meets a longer line.
+    while True:
+        try:
+            return pd.read_csv(StringIO(text), sep=r'\s+', header=None, names=range(width), quoting=csv.QUOTE_NONE)
+        except pd.errors.ParserError as e:
+            match = re.search(r'saw (\d+)', str(e))
+            if match is None:
+                raise
+            width = int(match.group(1))
+
+
+def parse_log_text(text):
+    # Lines look like "Epoch N key value key value ...". The key layout is taken
+    # from the file once; only lines that deviate from it go through the slower
+    # long-format pivot, never through per-row dicts. Lines whose second token is
+    # not an integer, such as banners and stderr in Slurm job output, are skipped.
+    first_line = text[:text.find('\n')] if '\n' in text else text
+    tokens = read_log_tokens(text, max(len(first_line.split()), 2))
+    epochs = tokens[1]
+    if not pd.api.types.is_integer_dtype(epochs):
+        if pd.api.types.is_float_dtype(epochs):
+            keep = epochs.notna() & (epochs == np.floor(epochs))
+        else:
+            keep = epochs.astype(str).str.fullmatch(r'[-+]?\d+')
+        tokens = tokens[keep.to_numpy(dtype=bool)].reset_index(drop=True)
+    if tokens.empty:
+        return pd.DataFrame()
+    key_columns = tokens.columns[2::2]
+
+    layout = []
+    for key_column in key_columns:
+        keys = tokens[key_column]
+        first_valid = keys.first_valid_index()
+        if first_valid is None:
+            continue
+        expected = keys[first_valid]
+        matches = keys.eq(expected)
+        if not matches.all() and not (matches | keys.isna()).all():
+            layout = None
+            break
+        layout.append((expected, key_column + 1))
+
+    if layout is not None and len({key for key, _ in layout}) == len(layout):
+        df = pd.DataFrame({key: to_float(tokens[column]) if column in tokens.columns
+                           else np.full(len(tokens), np.nan) for key, column in layout})
+    else:
+        rows = np.arange(len(tokens))
+        pairs = [(key_column, key_column + 1) for key_column in key_columns]
+        long = pd.DataFrame({
+            'row': np.tile(rows, len(pairs)),
+            'key': np.concatenate([tokens[k].to_numpy(dtype=object) for k, _ in pairs]),
+            'value': np.concatenate([to_float(tokens[v]).to_numpy() if v in tokens.columns
+                                     else np.full(len(tokens), np.nan) for _, v in pairs]),
+        }).dropna(subset=['key'])
+        long = long.drop_duplicates(['row', 'key'], keep='last')
+        df = long.pivot(index='row', columns='key', values='value').reindex(rows)
+        df = df[pd.unique(long['key'])]
+        df.columns.name = None
+    df.index = pd.Index(tokens[1].astype(np.int64).to_numpy(), name='Epoch')
+    return df
+
+
+def to_float(column):
+    if pd.api.types.is_float_dtype(column):
+        return column
+    return pd.to_numeric(column, errors='coerce').astype(np.float64)
+
+
+def iter_log_chunks(file, chunk_lines=LOG_CHUNK_LINES):
+    # Streams a log file as DataFrames of at most chunk_lines rows each
+    while True:
+        text = ''.join(itertools.islice(file, chunk_lines))
+        if not text:
+            return
+        df = parse_log_text(text)
         if not df.empty:
-            df.set_index('Epoch', inplace=True)
-        return df
+            yield df
+
+
+def read_log(file, chunk_lines=LOG_CHUNK_LINES):
+    chunks = list(iter_log_chunks(file, chunk_lines))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+
+
+def decode_json_records(text, lines=False):
+    # Decodes the complete records at the start of a piece of a JSON array or JSON
+    # Lines file and returns them with the number of characters they take. A record
+    # cut off at the end is left for the next piece, a broken line of JSON Lines is
+    # skipped. The piece is decoded in one call whenever it is well formed.
+    start = JSON_SEPARATORS.match(text).end()
+    end = text.rfind('\n') + 1 if lines else text.rfind('}') + 1
+    if end <= start:
+        return [], start
+    if lines:
+        body = ','.join(line for line in text[start:end].splitlines() if line.strip())
+    else:
+        body = text[start:end]
+    try:
+        return json.loads('[' + body + ']'), end
+    except json.JSONDecodeError:
+        pass
+
+    decoder = json.JSONDecoder()
+    records = []
+    position = consumed = start
+    skipped = 0
+    while position < end and text[position] != ']':
+        try:
+            record, position = decoder.raw_decode(text, position)
+        except json.JSONDecodeError:
+            if not lines:
+                break
+            skipped += 1
+            position = text.find('\n', position) + 1
+        else:
+            records.append(record)
+        consumed = position
+        position = JSON_SEPARATORS.match(text, position).end()
+    if skipped:
+        logging.warning(f"Skipped {skipped} malformed JSON lines")
+    return records, consumed
+
+
+def json_frame(records):
+    # A single object of equally long lists is a whole file in column layout
+    if len(records) == 1 and isinstance(records[0], dict) and records[0] \
+            and all(isinstance(value, list) for value in records[0].values()):
+        return pd.DataFrame(records[0])
+    return pd.DataFrame(records)
+
+
+def parse_json_text(text, file_ext):
+    # Returns the DataFrame of the complete records of the text and the characters they take
+    records, consumed = decode_json_records(text, lines=file_ext != ".json")
+    return json_frame(records), consumed
+
+
+def iter_json_chunks(file, file_ext, chunk_chars=JSON_CHUNK_CHARS):
+    # Streams a JSON array or JSON Lines file as DataFrames of the records of every
+    # chunk_chars characters. A record that does not fit yet makes the next read larger.
+    rest = ''
+    while True:
+        text = file.read(max(chunk_chars, len(rest)))
+        if not text:
+            return
+        rest += text
+        df, consumed = parse_json_text(rest, file_ext)
+        rest = rest[consumed:]
+        if not df.empty:
+            yield df
+
+
+def read_json(file, file_ext, chunk_chars=JSON_CHUNK_CHARS):
+    chunks = list(iter_json_chunks(file, file_ext, chunk_chars))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+def parse_text(text, file_ext, columns=None):
+    # Parses a piece of a metrics file. For csv, `columns` is the header of the
+    # file when the text is a tail without its own header line.
+    if file_ext == ".csv":
+        if columns is None:
+            return pd.read_csv(StringIO(text))
+        return pd.read_csv(StringIO(text), header=None, names=columns)
+    elif file_ext in JSON_FORMATS:
+        return parse_json_text(text, file_ext)[0]
+    elif file_ext in [".log", ".txt", ".out", ".err"]:
+        return parse_log_text(text)
     else:
         raise ValueError(f"Unsupported file type: {file_ext}")
 
 
+def overlay_runs(runs, metrics):
+    # Puts several runs side by side for comparison: a "run: metric" column per run
+    # and metric, and every metric group plots that metric of every run. Steps one
+    # run has and another lacks are interpolated so each run stays one line.
+    columns = list(dict.fromkeys(m for group in metrics for m in group))
+    frames = []
+    for label, df in runs.items():
+        present = [metric for metric in columns if metric in df.columns]
+        df = df.loc[~df.index.duplicated(keep='last'), present]
+        frames.append(df.rename(columns={metric: f"{label}: {metric}" for metric in present}))
+    if not frames:
+        return pd.DataFrame(), metrics
+    combined = pd.concat(frames, axis=1, sort=True)
+    combined = combined.apply(pd.to_numeric, errors='coerce').interpolate(limit_area='inside')
+    groups = [[f"{label}: {metric}" for metric in group for label in runs] for group in metrics]
+    return combined, groups
+
+
+def downsample(df, metrics, max_points=PLOT_MAX_POINTS, log_y=True):
+    # Min/max decimation: every bucket of rows keeps the rows where each column
+    # has its minimum and maximum, and the first row where it has a gap. Only
+    # real rows are kept, so every point is drawn at its own x, spikes and gaps
+    # stay visible and monotone series do not turn into staircases.
+    columns = [metric for metric in dict.fromkeys(m for group in metrics for m in group)
+               if metric in df.columns and pd.api.types.is_numeric_dtype(df[metric])]
+    num_buckets = max_points // (3 * len(columns)) if columns else 0
+    if len(df) <= max_points or num_buckets == 0:
+        return df
+    values = df[columns].to_numpy(dtype=np.float64)
+    if log_y:
+        # Non-positive values are not drawn on a log axis and must not win the minimum
+        values[values <= 0] = np.nan
+    bucket_size = math.ceil(len(df) / num_buckets)
+    num_buckets = math.ceil(len(df) / bucket_size)
+    pad = num_buckets * bucket_size - len(df)
+    blocks = np.pad(values, ((0, pad), (0, 0)), mode='edge').reshape(num_buckets, bucket_size, len(columns))
+
+    missing = np.isnan(blocks)
+    argmin = np.where(missing, np.inf, blocks).argmin(axis=1)
+    argmax = np.where(missing, -np.inf, blocks).argmax(axis=1)
+    first_gap = missing.argmax(axis=1)
+    starts = np.arange(num_buckets)[:, None] * bucket_size
+    positions = np.concatenate([(starts + argmin).ravel(), (starts + argmax).ravel(),
+                                (starts + first_gap)[missing.any(axis=1)]])
+    positions = np.unique(np.minimum(positions, len(df) - 1))
+    return pd.DataFrame(values[positions], index=df.index[positions], columns=columns)
+
+
 def plot_data(df, metrics):
     num_plots = len(metrics)
     num_cols = math.ceil(math.sqrt(num_plots))
@@ -85,10 +309,56 @@ def plot_data(df, metrics):
     return fig
 
 
+def plot_data_matplotlib(df, metrics):
+    # Same subplot grid as plot_data, drawn with the Agg canvas
+    num_plots = len(metrics)
+    num_cols = math.ceil(math.sqrt(num_plots))
+    num_rows = math.ceil(num_plots / num_cols)
+
+    fig = Figure(figsize=(7, num_rows * 4), dpi=100)  # 700 x 400 px per row, as in plot_data
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(num_rows, num_cols, squeeze=False)
+    fig.suptitle("Data Over Time")
+
+    for i, group in enumerate(metrics):
+        ax = axes[i // num_cols][i % num_cols]
+        for metric in group:
+            if metric in df.columns:
+                ax.plot(df.index, df[metric], label=metric)
+        ax.set_title(f"Metrics Group {i + 1}")
+        ax.set_xlabel("Epoch")
+        ax.set_ylabel("Value")
+        ax.set_yscale('log')
+        ax.yaxis.set_major_locator(LogLocator(numticks=LOG_TICKS))
+        ax.yaxis.set_minor_locator(LogLocator(subs=(2, 5), numticks=LOG_TICKS))
+        if ax.has_data():
+            # 'best' would test every position against every drawn point
+            ax.legend(loc='upper right', fontsize='small')
+
+    for i in range(num_plots, num_rows * num_cols):
+        axes[i // num_cols][i % num_cols].set_visible(False)
+
+    # Fixed margins in inches instead of tight_layout, which measures the bounding box of every tick label
+    width, height = fig.get_size_inches()
+    axes_width = (width - 0.95 - (num_cols - 1) * 0.85) / num_cols
+    axes_height = (height - 1.3 - (num_rows - 1) * 0.9) / num_rows
+    fig.subplots_adjust(left=0.75 / width, right=1 - 0.2 / width, bottom=0.55 / height, top=1 - 0.75 / height,
+                        wspace=0.85 / axes_width, hspace=0.9 / axes_height)
+    return fig
+
+
 def plot_and_send_file(file_path, metrics):
-    df = read_data(file_path)
-    fig = plot_data(df, metrics)
+    df = downsample(read_data(file_path), metrics)
+    return plot_to_buffer(df, metrics)
+
+
+def plot_to_buffer(df, metrics, backend='plotly'):
     buf = BytesIO()
-    buf.write(to_image(fig, format='png', scale=1))
+    if backend == 'matplotlib':
+        fig = plot_data_matplotlib(df, metrics)
+        fig.savefig(buf, format='png')
+    else:
+        fig = plot_data(df, metrics)
+        buf.write(to_image(fig, format='png', scale=1))
     buf.seek(0)
     return buf
@@ -0,0 +1,149 @@
+import base64
+import json
+import logging
+import shlex
+import zlib
+
+from config import PLOT_MAX_POINTS, TRANSFER_TIMEOUT
+from functions.async_ssh import exec_command
+
+# Runs on the remote host: parses the metrics file, keeps the requested columns,
+# reduces them with the same min/max bucketing as plotting.downsample and prints
+# a JSON header line followed by zlib-compressed little-endian arrays.
+HELPER = r'''
+import sys, os, re, json, zlib, struct, math
+from array import array
+path, max_points, columns = sys.argv[1], int(sys.argv[2]), sys.argv[3:]
+ext = os.path.splitext(path)[1].lower()
+index, series = array('d'), dict((c, array('d')) for c in columns)
+nan = float('nan')
+def num(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return nan
+def add(x, row):
+    index.append(x)
+    for c in columns:
+        series[c].append(num(row.get(c)))
+index_name = None
+if ext == '.csv':
+    import csv
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        for i, row in enumerate(reader):
+            add(i, row)
+elif ext in ('.json', '.jsonl', '.ndjson'):
+    with open(path) as f:
+        text = f.read()
+    # Records one at a time: a half-written last record or a broken line is skipped
+    decoder, sep, data, pos = json.JSONDecoder(), re.compile(r'[\s,\[]*'), [], 0
+    while True:
+        pos = sep.match(text, pos).end()
+        if pos >= len(text) or text[pos] == ']':
+            break
+        try:
+            value, pos = decoder.raw_decode(text, pos)
+        except ValueError:
+            pos = text.find('\n', pos) + 1
+            if ext == '.json' or not pos:
+                break
+            continue
+        data.append(value)
+    if len(data) == 1 and isinstance(data[0], dict) and all(isinstance(v, list) for v in data[0].values()):
+        data = data[0]
+    if isinstance(data, dict):
+        n = max([len(v) for v in data.values()] or [0])
+        data = [dict((k, v[i] if i < len(v) else None) for k, v in data.items()) for i in range(n)]
+    for i, row in enumerate(data):
+        add(i, row)
+else:
+    index_name = 'Epoch'
+    with open(path) as f:
+        for line in f:
+            t = line.split()
+            if len(t) < 2 or not re.match(r'[-+]?\d+$', t[1]):
+                continue
+            add(float(t[1]), dict(zip(t[2::2], t[3::2])))
+n = len(index)
+buckets = max_points // (3 * len(columns)) if columns else 0
+if n > max_points and buckets:
+    size = int(math.ceil(n / float(buckets)))
+    def valid(x):
+        return x == x and not (LOG and x <= 0)
+    def first(pair):
+        return pair[0]
+    keep = set()
+    for c in columns:
+        v = series[c]
+        for s in range(0, n, size):
+            e = min(s + size, n)
+            block = [(v[j], j) for j in range(s, e) if valid(v[j])]
+            if block:
+                keep.update((min(block, key=first)[1], max(block, key=first)[1]))
+            if len(block) < e - s:
+                keep.add(next(j for j in range(s, e) if not valid(v[j])))
+    rows = sorted(keep)
+    index = array('d', [index[j] for j in rows])
+    for c in columns:
+        series[c] = array('d', [series[c][j] if valid(series[c][j]) else nan for j in rows])
+payload = index.tostring() if sys.version_info[0] < 3 else index.tobytes()
+for c in columns:
+    payload += series[c].tostring() if sys.version_info[0] < 3 else series[c].tobytes()
+header = json.dumps({'rows': len(index), 'columns': columns, 'index_name': index_name,
+                     'little': sys.byteorder == 'little'})
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+out.write((header + '\n').encode('utf-8'))
+out.write(zlib.compress(payload, 6))
+'''
+
+interpreters = {}  # id(ssh_client) -> remote python interpreter, or None when missing
+
+
+def helper_command(interpreter, file_path, columns, max_points=PLOT_MAX_POINTS, log_y=True):
+    source = f"LOG = {log_y}\n" + HELPER
+    packed = base64.b64encode(zlib.compress(source.encode('utf-8'))).decode('ascii')
+    bootstrap = f"import base64,zlib;exec(zlib.decompress(base64.b64decode('{packed}')))"
+    args = ' '.join(shlex.quote(str(arg)) for arg in [file_path, max_points, *columns])
+    return f"{interpreter} -c {shlex.quote(bootstrap)} {args}"
+
+
+def decode_payload(raw):
+    import numpy as np
+    import pandas as pd
+    header, _, body = raw.partition(b'\n')
+    header = json.loads(header)
+    dtype = '<f8' if header['little'] else '>f8'
+    arrays = np.frombuffer(zlib.decompress(body), dtype=dtype).reshape(len(header['columns']) + 1, header['rows'])
+    index = arrays[0]
+    if len(index) and np.all(index == np.round(index)):
+        index = index.astype(np.int64)
+    df = pd.DataFrame({column: arrays[i + 1] for i, column in enumerate(header['columns'])},
+                      index=pd.Index(index, name=header['index_name']))
+    return df
+
+
+async def find_interpreter(ssh_client):
+    key = id(ssh_client)
+    if key not in interpreters:
+        output, error = await exec_command(ssh_client, 'command -v python3 || command -v python')
+        interpreters[key] = output.splitlines()[0] if output else None
+        if interpreters[key] is None:
+            logging.info("No python interpreter on the remote host, remote aggregation disabled")
+    return interpreters[key]
+
+
+async def fetch_aggregated(ssh_client, file_path, metrics):
+    # Returns a reduced DataFrame built on the remote host, or None if the host
+    # cannot run the helper and the caller should read the raw file instead
+    interpreter = await find_interpreter(ssh_client)
+    if interpreter is None:
+        return None
+    columns = list(dict.fromkeys(metric for group in metrics for metric in group))
+    command = helper_command(interpreter, file_path, columns)
+    output, error = await exec_command(ssh_client, command, timeout=TRANSFER_TIMEOUT, raw=True)
+    try:
+        return decode_payload(output)
+    except Exception as e:
+        logging.error(f"Remote aggregation of {file_path} failed: {e} {error.decode('utf-8', errors='replace')[-500:]}")
+        return None
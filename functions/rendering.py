@@ -0,0 +1,147 @@
+import asyncio
+import hashlib
+import importlib
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from config import PLOT_BACKEND, RENDER_WORKERS, RENDER_TIMEOUT, RENDER_CACHE_ENTRIES, RENDER_CACHE_BYTES, WARM_UP_DELAY
+from functions.instrumentation import span, register_gauge
+
+# Render pool and plot cache. pandas, plotly and matplotlib are imported on first
+# use, so importing this module does not load them.
+
+render_pool = None
+render_cache = OrderedDict()  # plot key -> PNG bytes, least recently used first
+render_cache_bytes = 0
+pending_renders = {}  # plot key -> future of the render in progress
+render_stats = {'hits': 0, 'misses': 0, 'shared': 0}
+warm_up_task = None
+register_gauge('render_cache', lambda: render_cache_stats())
+register_gauge('renders_in_progress', lambda: len(pending_renders))
+
+
+def render_png(df, metrics, backend):
+    from functions.plotting import plot_to_buffer
+    buf = plot_to_buffer(df, metrics, backend)
+    return buf.getvalue()
+
+
+def warm_up_worker():
+    # Pays the kaleido start-up and matplotlib font cache cost once per worker
+    import pandas as pd
+    df = pd.DataFrame({'value': [1.0, 2.0]})
+    try:
+        render_png(df, [['value']], 'plotly')
+        render_png(df, [['value']], 'matplotlib')
+    except Exception as e:
+        logging.error(f"Render worker warm-up failed: {e}")
+
+
+def get_render_pool():
+    global render_pool
+    if render_pool is None:
+        # Workers start from the single-threaded fork server rather than a fork of the bot,
+        # whose event loop and SSH threads could hold locks; warm_up_worker loads the plotting stack
+        render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                          mp_context=multiprocessing.get_context('forkserver'),
+                                          initializer=warm_up_worker)
+    return render_pool
+
+
+def warm_render_pool():
+    pool = get_render_pool()
+    for _ in range(RENDER_WORKERS):
+        pool.submit(int)
+
+
+def reset_render_pool():
+    global render_pool
+    pool, render_pool = render_pool, None
+    if pool is None:
+        return
+    # A worker stuck in kaleido never returns by itself, so the processes are killed
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def plot_key(df, metrics, backend):
+    # Content address of a plot: the drawn series and the plot configuration
+    import pandas as pd
+    columns = [metric for metric in dict.fromkeys(m for group in metrics for m in group) if metric in df.columns]
+    digest = hashlib.blake2b(repr((metrics, backend, columns, df.index.name)).encode('utf-8'), digest_size=16)
+    digest.update(pd.util.hash_pandas_object(df[columns], index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def store_render(key, png):
+    global render_cache_bytes
+    render_cache[key] = png
+    render_cache_bytes += len(png)
+    while render_cache and (len(render_cache) > RENDER_CACHE_ENTRIES or render_cache_bytes > RENDER_CACHE_BYTES):
+        render_cache_bytes -= len(render_cache.popitem(last=False)[1])
+
+
+def finish_render(key, future):
+    pending_renders.pop(key, None)
+    if not future.cancelled() and future.exception() is None:
+        store_render(key, future.result())
+
+
+def render_cache_stats():
+    return {'hits': render_stats['hits'], 'misses': render_stats['misses'], 'shared': render_stats['shared'],
+            'entries': len(render_cache), 'bytes': render_cache_bytes}
+
+
+async def render_uncached(df, metrics, backend, timeout):
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_render_pool(), render_png, df, metrics, backend)
+    try:
+        with span(f'render_{backend}'):
+            return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        logging.error(f"Rendering with {backend} did not finish in {timeout} s, restarting render workers")
+        reset_render_pool()
+        raise
+
+
+async def render_plot(df, metrics, backend=PLOT_BACKEND, timeout=RENDER_TIMEOUT):
+    # Identical plots are rendered once: finished ones come from the LRU cache,
+    # callers asking for one that is being rendered wait for the same render
+    from functions.plotting import downsample
+    df = downsample(df, metrics)
+    key = plot_key(df, metrics, backend)
+    png = render_cache.get(key)
+    if png is not None:
+        render_cache.move_to_end(key)
+        render_stats['hits'] += 1
+        return png
+    future = pending_renders.get(key)
+    if future is not None:
+        render_stats['shared'] += 1
+    else:
+        render_stats['misses'] += 1
+        future = asyncio.ensure_future(render_uncached(df, metrics, backend, timeout))
+        future.add_done_callback(partial(finish_render, key))
+        pending_renders[key] = future
+    return await asyncio.shield(future)
+
+
+async def warm_up(delay=WARM_UP_DELAY):
+    # The bot answers right away; the plotting stack and render workers load once it is idle
+    await asyncio.sleep(delay)
+    try:
+        await asyncio.to_thread(importlib.import_module, 'functions.plotting')
+        warm_render_pool()
+    except Exception as e:
+        logging.error(f"Plotting warm-up failed: {e}")
+
+
+async def start_warm_up():
+    # A coroutine: aiogram runs plain startup hooks in a thread, where there is no event loop
+    global warm_up_task
+    if warm_up_task is None:
+        warm_up_task = asyncio.create_task(warm_up())
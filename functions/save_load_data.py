@@ -1,22 +1,169 @@
+import asyncio
 import json
+import logging
+import os
+import sqlite3
+import threading
 
+from config import STORE_PATH, STORE_FLUSH_INTERVAL, STORE_BATCH_SIZE
 
-def save_connection_details(user_id, host, username, port=2222):
-    connection_details = {user_id: {'host': host, 'username': username, 'port': port}}
+LEGACY_PATH = 'ssh_connections.json'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS connections (
+    user_id INTEGER PRIMARY KEY,
+    login TEXT NOT NULL,
+    host TEXT NOT NULL,
+    port INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS monitors (
+    task_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    metrics TEXT NOT NULL,
+    interval REAL NOT NULL
+);
+'''
+
+database = None
+database_lock = threading.Lock()
+pending_writes = {}  # (table, key) -> row to upsert, or None to delete; later writes replace earlier ones
+flush_event = None
+writer_task = None
+
+
+def open_store(path=STORE_PATH):
+    global database
+    if database is not None:
+        return database
+    database = sqlite3.connect(path, check_same_thread=False)
+    # WAL lets reads go on while a batch is written, NORMAL syncs once per checkpoint
+    database.execute('PRAGMA journal_mode=WAL')
+    database.execute('PRAGMA synchronous=NORMAL')
+    database.executescript(SCHEMA)
+    migrate_legacy(database)
+    return database
+
+
+def migrate_legacy(db):
+    # Imports ssh_connections.json once; its keys were strings while user ids are ints
+    if not os.path.exists(LEGACY_PATH):
+        return
     try:
-        with open('ssh_connections.json', 'r') as file:
-            existing_details = json.load(file)
-    except FileNotFoundError:
-        existing_details = {}
+        with open(LEGACY_PATH, 'r') as file:
+            details = json.load(file)
+        with db:
+            db.executemany('INSERT OR IGNORE INTO connections VALUES (?, ?, ?, ?)',
+                           [(int(user_id), value.get('username') or value.get('login'), value['host'],
+                             int(value.get('port', 2222))) for user_id, value in details.items()])
+        os.replace(LEGACY_PATH, LEGACY_PATH + '.migrated')
+        logging.info(f"Migrated {len(details)} connections from {LEGACY_PATH}")
+    except Exception as e:
+        logging.error(f"Failed to migrate {LEGACY_PATH}: {e}")
 
-    existing_details.update(connection_details)
 
-    with open('ssh_connections.json', 'w') as file:
-        json.dump(existing_details, file, indent=4)
+def write_batch(writes):
+    db = open_store()
+    with database_lock, db:
+        for (table, key), row in writes.items():
+            if row is None:
+                column = 'user_id' if table == 'connections' else 'task_id'
+                db.execute(f'DELETE FROM {table} WHERE {column} = ?', (key,))
+            elif table == 'connections':
+                db.execute('INSERT INTO connections VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE '
+                           'SET login = excluded.login, host = excluded.host, port = excluded.port', row)
+            else:
+                db.execute('INSERT OR REPLACE INTO monitors VALUES (?, ?, ?, ?, ?)', row)
 
-def load_connection_details():
+
+def take_pending():
+    global pending_writes
+    writes, pending_writes = pending_writes, {}
+    return writes
+
+
+def flush_now():
+    writes = take_pending()
+    if writes:
+        write_batch(writes)
+
+
+async def flush():
+    global pending_writes
+    writes = take_pending()
+    if not writes:
+        return
     try:
-        with open('ssh_connections.json', 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return {}
+        await asyncio.to_thread(write_batch, writes)
+    except Exception:
+        # Kept for the next batch unless newer writes for the same keys arrived meanwhile
+        pending_writes = {**writes, **pending_writes}
+        raise
+
+
+async def run_writer():
+    # Write-behind: changes are collected for STORE_FLUSH_INTERVAL seconds, or until
+    # STORE_BATCH_SIZE are pending, and committed as one transaction
+    while pending_writes:
+        try:
+            await asyncio.wait_for(flush_event.wait(), STORE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        flush_event.clear()
+        try:
+            await flush()
+        except Exception as e:
+            logging.error(f"Failed to write to {STORE_PATH}: {e}")
+
+
+def queue_write(table, key, row):
+    global flush_event, writer_task
+    pending_writes[(table, key)] = row
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # Outside the event loop there is nothing to batch with
+        flush_now()
+        return
+    if flush_event is None:
+        flush_event = asyncio.Event()
+    if len(pending_writes) >= STORE_BATCH_SIZE:
+        flush_event.set()
+    if writer_task is None or writer_task.done():
+        writer_task = asyncio.create_task(run_writer())
+
+
+def save_connection_details(user_id, host, username, port=2222):
+    queue_write('connections', user_id, (user_id, username, host, port))
+
+
+def load_connection_details():
+    db = open_store()
+    with database_lock:
+        rows = db.execute('SELECT user_id, login, host, port FROM connections').fetchall()
+    return {user_id: {'login': login, 'host': host, 'port': port} for user_id, login, host, port in rows}
+
+
+def save_monitoring(task_id, user_id, path, metrics, interval):
+    queue_write('monitors', task_id, (task_id, user_id, path, json.dumps(metrics), interval))
+
+
+def delete_monitoring(task_id):
+    queue_write('monitors', task_id, None)
+
+
+def load_monitoring():
+    db = open_store()
+    with database_lock:
+        rows = db.execute('SELECT task_id, user_id, path, metrics, interval FROM monitors').fetchall()
+    return [{'task_id': task_id, 'user_id': user_id, 'path': path, 'metrics': json.loads(metrics),
+             'interval': interval} for task_id, user_id, path, metrics, interval in rows]
+
+
+async def close_store():
+    global database
+    if writer_task is not None:
+        writer_task.cancel()
+    flush_now()
+    if database is not None:
+        database.close()
+        database = None
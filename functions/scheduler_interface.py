@@ -1,26 +1,228 @@
+import asyncio
+import re
+import shlex
+
+from config import QUEUE_CACHE_TTL, QUEUE_PAGE_SIZE, CANCEL_MAX_RANGE
+from functions.async_ssh import exec_command
+
+# The job name goes last so that a '|' inside it cannot shift the other fields
+QUEUE_FIELDS = ['job_id', 'partition', 'user', 'state', 'time', 'nodes', 'reason', 'name']
+SQUEUE_COMMAND = "squeue --noheader --format='%i|%P|%u|%T|%M|%D|%R|%j'"
+
+queue_snapshots = {}  # cluster (peer address) -> {'time': loop time, 'jobs': [dict, ...]}
+queue_requests = {}  # cluster -> Task fetching a fresh snapshot, shared by concurrent callers
+
+GLOB_CHARS = re.compile(r'[*?\[]')
+PARSABLE_ID = re.compile(r'^(\d+)(;\S+)?$')  # sbatch --parsable prints "job_id[;cluster]"
+MESSAGE_LIMIT = 4000
+
+
+def shell_glob(token):
+    # Escapes everything except the glob characters so the remote shell expands only those
+    return re.sub(r'([^\w*?\[\]/.\-])', r'\\\1', token)
+
+
+def submit_command(job_scripts, array_spec=None):
+    # One shell loop submits every script and prints "path|OK|job_id" or "path|ERR|message".
+    # sbatch warnings share the output, the job id is its last line.
+    words = ' '.join(shell_glob(path) if GLOB_CHARS.search(path) else shlex.quote(path) for path in job_scripts)
+    array = f" --array={shlex.quote(array_spec)}" if array_spec else ''
+    return (f'for f in {words}; do '
+            f'if [ ! -e "$f" ]; then printf \'%s|ERR|%s\\n\' "$f" "No such file"; continue; fi; '
+            f'out=$(sbatch --parsable{array} -- "$f" 2>&1); rc=$?; '
+            f'last=$(printf \'%s\\n\' "$out" | tail -n 1); '
+            f'out=$(printf \'%s\' "$out" | tr \'\\n\' \' \'); '
+            f'if [ $rc -eq 0 ]; then printf \'%s|OK|%s\\n\' "$f" "$last"; '
+            f'else printf \'%s|ERR|%s\\n\' "$f" "$out"; fi; done')
+
+
+def parse_submit_args(text):
+    # Paths, globs and an optional --array=SPEC applied to every script
+    scripts, array_spec = [], None
+    for token in shlex.split(text):
+        if token.startswith('--array='):
+            array_spec = token.split('=', 1)[1]
+        else:
+            scripts.append(token)
+    return scripts, array_spec
+
+
+def parse_results(output):
+    results = []
+    for line in output.splitlines():
+        parts = line.split('|', 2)
+        if len(parts) == 3:
+            results.append((parts[0], parts[1] == 'OK', parts[2].strip()))
+    return results
+
+
+def format_results(results, ok_text, limit=MESSAGE_LIMIT):
+    ok = sum(1 for _, success, _ in results if success)
+    lines = [f"{ok_text}: {ok} из {len(results)}"]
+    for item, success, text in results:
+        lines.append(f"{item}: {text}" if success else f"{item}: ошибка - {text}")
+    response = '\n'.join(lines)
+    if len(response) > limit:
+        response = response[:limit] + "\n..."
+    return response
+
+
 async def submit_job(ssh_client, job_script):
+    # Returns (response text, ids of the submitted jobs)
     try:
-        stdin, stdout, stderr = ssh_client.exec_command(f'sbatch {job_script}')
-        output = stdout.read().decode('utf-8').strip()
-        error = stderr.read().decode('utf-8').strip()
-        return output or error or "Задача отправлена на выполнение."
+        scripts, array_spec = parse_submit_args(job_script)
+        if not scripts:
+            return "Не указан путь к скрипту задачи.", []
+        output, error = await exec_command(ssh_client, submit_command(scripts, array_spec))
+        results = parse_results(output)
+        if not results:
+            return error or "Задача отправлена на выполнение.", []
+        job_ids = [match.group(1) for match in (PARSABLE_ID.match(text) for _, success, text in results if success)
+                   if match]
+        return format_results(results, "Отправлено задач"), job_ids
     except Exception as e:
-        return f"Ошибка при отправке задачи: {e}"
+        return f"Ошибка при отправке задачи: {e}", []
+
+
+def cluster_key(ssh_client):
+    return ssh_client.get_transport().getpeername()
 
 
-async def show_queue(ssh_client):
+def parse_queue(output):
+    jobs = []
+    for line in output.splitlines():
+        values = line.split('|', len(QUEUE_FIELDS) - 1)
+        if len(values) == len(QUEUE_FIELDS):
+            jobs.append(dict(zip(QUEUE_FIELDS, values)))
+    return jobs
+
+
+async def fetch_queue(ssh_client):
+    output, error = await exec_command(ssh_client, SQUEUE_COMMAND)
+    if error and not output:
+        raise RuntimeError(error)
+    return parse_queue(output)
+
+
+async def get_queue_snapshot(ssh_client):
+    # One squeue per cluster and QUEUE_CACHE_TTL, shared by every user on that host
+    key = cluster_key(ssh_client)
+    loop = asyncio.get_running_loop()
+    snapshot = queue_snapshots.get(key)
+    if snapshot is not None and loop.time() - snapshot['time'] < QUEUE_CACHE_TTL:
+        return snapshot['jobs']
+    request = queue_requests.get(key)
+    if request is None:
+        request = asyncio.create_task(fetch_queue(ssh_client))
+        queue_requests[key] = request
+        request.add_done_callback(lambda _: queue_requests.pop(key, None))
+    jobs = await asyncio.shield(request)
+    queue_snapshots[key] = {'time': loop.time(), 'jobs': jobs}
+    return jobs
+
+
+def parse_queue_filters(args):
+    # "mine", "partition=gpu", "state=RUNNING" in any combination
+    filters = {}
+    for arg in args:
+        if arg.lower() in ('mine', 'my'):
+            filters['mine'] = True
+        elif '=' in arg:
+            name, value = arg.split('=', 1)
+            if name.lower() in ('partition', 'state', 'user'):
+                filters[name.lower()] = value
+    return filters
+
+
+def filter_jobs(jobs, filters, username=None):
+    result = jobs
+    if filters.get('mine') and username:
+        result = [job for job in result if job['user'] == username]
+    if 'user' in filters:
+        result = [job for job in result if job['user'] == filters['user']]
+    if 'partition' in filters:
+        result = [job for job in result if job['partition'] == filters['partition']]
+    if 'state' in filters:
+        state = filters['state'].upper()
+        result = [job for job in result if job['state'] == state]
+    return result
+
+
+def format_queue_page(jobs, page):
+    pages = max((len(jobs) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    lines = [f"Задач: {len(jobs)}, страница {page + 1}/{pages}",
+             "JOBID PARTITION USER STATE TIME NODES NAME REASON"]
+    for job in jobs[page * QUEUE_PAGE_SIZE:(page + 1) * QUEUE_PAGE_SIZE]:
+        lines.append(f"{job['job_id']} {job['partition']} {job['user']} {job['state']} {job['time']} "
+                     f"{job['nodes']} {job['name']} {job['reason']}")
+    return '\n'.join(lines), page, pages
+
+
+async def show_queue(ssh_client, filters=None, page=0):
+    # Returns (text, page, number of pages)
     try:
-        stdin, stdout, stderr = ssh_client.exec_command('squeue')
-        output = stdout.read().decode('utf-8').strip()
-        return output or "Очередь задач пуста."
+        jobs = await get_queue_snapshot(ssh_client)
+        jobs = filter_jobs(jobs, filters or {}, ssh_client.get_transport().get_username())
+        if not jobs:
+            return "Очередь задач пуста.", 0, 1
+        return format_queue_page(jobs, page)
     except Exception as e:
-        return f"Ошибка при просмотре очереди задач: {e}"
+        return f"Ошибка при просмотре очереди задач: {e}", 0, 1
+
+
+def parse_cancel_args(text):
+    # "1 2 3", "1,2,3", "100-120", "123_4" and "state=PENDING" (all own jobs in that state)
+    job_ids, state = [], None
+    for token in re.split(r'[\s,]+', text.strip()):
+        if not token:
+            continue
+        if token.lower().startswith('state='):
+            state = token.split('=', 1)[1].upper()
+        elif token.lower() == 'all':
+            state = 'ALL'
+        elif re.fullmatch(r'\d+-\d+', token):
+            start, end = map(int, token.split('-'))
+            if end < start or end - start >= CANCEL_MAX_RANGE:
+                raise ValueError(f"Некорректный диапазон {token}")
+            job_ids.extend(str(job_id) for job_id in range(start, end + 1))
+        elif re.fullmatch(r'\d+(_\d+)?', token):
+            job_ids.append(token)
+        else:
+            raise ValueError(f"Некорректный ID задачи {token}")
+    return job_ids, state
+
+
+def cancel_command(job_ids, state=None):
+    # A single scancel for every job; failures are reported per job on stderr
+    if state is not None:
+        state_filter = '' if state == 'ALL' else f" -t {shlex.quote(state)}"
+        return (f'ids=$(squeue -h -u "$USER"{state_filter} -o %i | tr \'\\n\' \' \'); '
+                f'echo "ids=$ids"; if [ -n "$ids" ]; then scancel $ids 2>&1; fi')
+    return f'echo "ids={" ".join(job_ids)}"; scancel {" ".join(job_ids)} 2>&1'
+
+
+def parse_cancel_output(output):
+    job_ids, errors = [], {}
+    for line in output.splitlines():
+        if line.startswith('ids='):
+            job_ids = line[4:].split()
+            continue
+        match = re.search(r'job(?: id)? (\d+(?:_\d+)?)\W*(.*)', line, re.IGNORECASE)
+        if match:
+            errors[match.group(1)] = match.group(2).strip() or line.strip()
+    return [(job_id, job_id not in errors, errors.get(job_id, "отменена")) for job_id in job_ids]
 
 
-async def cancel_job(ssh_client, job_id):
+async def cancel_job(ssh_client, job_spec):
     try:
-        stdin, stdout, stderr = ssh_client.exec_command(f'scancel {job_id}')
-        output = stdout.read().decode('utf-8').strip()
-        return output or "Задача отменена."
+        job_ids, state = parse_cancel_args(job_spec)
+        if not job_ids and state is None:
+            return "Пожалуйста, укажите ID задачи."
+        output, error = await exec_command(ssh_client, cancel_command(job_ids, state))
+        results = parse_cancel_output(output)
+        if not results:
+            return "Подходящих задач не найдено."
+        return format_results(results, "Отменено задач")
     except Exception as e:
         return f"Ошибка при отмене задачи: {e}"
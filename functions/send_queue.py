@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import SEND_GLOBAL_RATE, SEND_CHAT_INTERVAL, SEND_MAX_RETRIES
+from functions.instrumentation import span, count, register_gauge, record
+
+pending = {}  # key -> request, in the order they were queued
+chat_ready = {}  # chat_id -> loop time from which the chat may receive again
+busy_chats = set()  # chats with a request in flight, each chat gets one at a time
+next_send = 0  # loop time of the next send allowed by the global limit
+global_rate = SEND_GLOBAL_RATE  # Share of the bot-wide limit used by this process
+request_ids = itertools.count(1)
+wakeup = None
+worker_task = None
+register_gauge('send_queue_depth', lambda: len(pending))
+
+
+def ensure_worker():
+    global wakeup, worker_task
+    if wakeup is None:
+        wakeup = asyncio.Event()
+    wakeup.set()
+    if worker_task is None or worker_task.done():
+        worker_task = asyncio.create_task(process_queue())
+
+
+def enqueue(chat_id, send, key=None):
+    # send is a coroutine function making the API call. A request with the key of
+    # a pending one replaces it in place, so of several plot updates of a task
+    # only the newest goes out. Returns a future with the result of the call.
+    loop = asyncio.get_running_loop()
+    if key is None:
+        key = ('request', next(request_ids))
+    request = pending.get(key)
+    if request is None:
+        request = pending[key] = {'chat_id': chat_id, 'future': loop.create_future(), 'retries': 0,
+                                  'queued': loop.time()}
+    else:
+        count('send_coalesced')
+    request['send'] = send
+    ensure_worker()
+    return request['future']
+
+
+def discard(key):
+    request = pending.pop(key, None)
+    if request is not None and not request['future'].done():
+        request['future'].set_result(None)
+
+
+def next_request(now):
+    for key, request in pending.items():
+        chat_id = request['chat_id']
+        if chat_id not in busy_chats and chat_ready.get(chat_id, 0) <= now:
+            return key
+    return None
+
+
+async def deliver(key, request):
+    chat_id = request['chat_id']
+    loop = asyncio.get_running_loop()
+    record('send_queue_wait', loop.time() - request['queued'])
+    try:
+        with span('telegram_send'):
+            result = await request['send']()
+    except TelegramRetryAfter as e:
+        count('send_retry_after')
+        chat_ready[chat_id] = loop.time() + e.retry_after
+        request['retries'] += 1
+        logging.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after} s")
+        if key in pending or request['retries'] > SEND_MAX_RETRIES:
+            # A newer update replaced this one meanwhile, or it keeps failing
+            request['future'].set_result(None)
+        else:
+            pending[key] = request
+        return
+    except Exception as e:
+        logging.error(f"Failed to send to chat {chat_id}: {e}")
+        request['future'].set_result(None)
+        return
+    finally:
+        busy_chats.discard(chat_id)
+        ensure_worker()
+    request['future'].set_result(result)
+
+
+async def process_queue():
+    global next_send
+    loop = asyncio.get_running_loop()
+    while pending:
+        now = loop.time()
+        key = next_request(now)
+        if key is None or next_send > now:
+            if key is None:
+                waiting = [chat_ready.get(request['chat_id'], 0) for request in pending.values()
+                           if request['chat_id'] not in busy_chats]
+                # Chats that are only busy wake the loop up themselves when done
+                wait = max(min(waiting) - now, 0) if waiting else None
+            else:
+                wait = next_send - now
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        request = pending.pop(key)
+        next_send = now + 1 / global_rate
+        chat_ready[request['chat_id']] = now + SEND_CHAT_INTERVAL
+        busy_chats.add(request['chat_id'])
+        asyncio.create_task(deliver(key, request))
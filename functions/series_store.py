@@ -0,0 +1,133 @@
+import threading
+import weakref
+
+from config import MONITOR_TASK_MEMORY, MONITOR_MEMORY_BUDGET
+from functions.instrumentation import register_gauge
+
+INITIAL_ROWS = 4096  # Buffers start small and double up to the task budget
+MIN_ROWS = 1024  # The global budget never shrinks a store below this
+
+stores = weakref.WeakSet()  # Every live store, for the global budget
+stores_lock = threading.Lock()  # Stores are filled from the SSH thread pool
+register_gauge('series_store_bytes', lambda: total_bytes())
+
+
+class SeriesStore:
+    # History of one monitored file: int64 steps and one float32 column per plotted
+    # metric in preallocated buffers. Once a buffer reaches its budget every other
+    # stored row is dropped and from then on only every stride-th row of the file is
+    # kept, so the whole history stays, evenly and ever more coarsely sampled.
+    __slots__ = ('columns', 'index_name', 'steps', 'values', 'length', 'rows_seen', 'stride', 'max_rows',
+                 '__weakref__')
+
+    def __init__(self, columns, budget=MONITOR_TASK_MEMORY):
+        self.columns = list(columns)
+        self.index_name = None
+        self.steps = None
+        self.values = None
+        self.length = 0
+        self.rows_seen = 0
+        self.stride = 1
+        self.max_rows = max(budget // (8 + 4 * len(self.columns)), MIN_ROWS)
+        with stores_lock:
+            stores.add(self)
+
+    def nbytes(self):
+        return self.steps.nbytes + self.values.nbytes if self.steps is not None else 0
+
+    def allocate(self, rows, dtype=None):
+        # Fresh arrays rather than resizing in place, frames handed out earlier stay intact
+        import numpy as np
+        steps = np.empty(rows, dtype=dtype or self.steps.dtype)
+        values = np.empty((rows, len(self.columns)), dtype=np.float32)
+        if self.length:
+            steps[:self.length] = self.steps[:self.length]
+            values[:self.length] = self.values[:self.length]
+        self.steps, self.values = steps, values
+
+    def thin(self):
+        # Stored rows are the file rows 0, stride, 2 * stride, ...; the even ones stay
+        import numpy as np
+        steps, values = np.empty_like(self.steps), np.empty_like(self.values)
+        length = (self.length + 1) // 2
+        steps[:length] = self.steps[:self.length:2]
+        values[:length] = self.values[:self.length:2]
+        self.steps, self.values, self.length = steps, values, length
+        self.stride *= 2
+
+    def append(self, df):
+        # Takes the rows of a freshly parsed piece of the file. A RangeIndex (csv,
+        # json) continues the row count of the earlier pieces.
+        import numpy as np
+        import pandas as pd
+        if df.empty:
+            return
+        if isinstance(df.index, pd.RangeIndex):
+            steps = np.arange(self.rows_seen, self.rows_seen + len(df), dtype=np.int64)
+        else:
+            steps = df.index.to_numpy()
+            if not np.issubdtype(steps.dtype, np.number):
+                steps = np.arange(self.rows_seen, self.rows_seen + len(df), dtype=np.int64)
+        values = np.full((len(df), len(self.columns)), np.nan, dtype=np.float32)
+        for i, column in enumerate(self.columns):
+            if column in df.columns:
+                values[:, i] = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=np.float32)
+        with stores_lock:
+            if self.steps is None:
+                self.index_name = df.index.name
+                self.allocate(min(INITIAL_ROWS, self.max_rows),
+                              np.int64 if np.issubdtype(steps.dtype, np.integer) else np.float64)
+            position = 0
+            while position < len(steps):
+                if self.length == len(self.steps):
+                    if len(self.steps) < self.max_rows:
+                        self.allocate(min(len(self.steps) * 2, self.max_rows))
+                    else:
+                        self.thin()
+                # The rows of this piece that fall on the stride, as many as fit
+                first = position + (-(self.rows_seen + position)) % self.stride
+                rows = np.arange(first, len(steps), self.stride)[:len(self.steps) - self.length]
+                if not len(rows):
+                    break
+                self.steps[self.length:self.length + len(rows)] = steps[rows]
+                self.values[self.length:self.length + len(rows)] = values[rows]
+                self.length += len(rows)
+                position = rows[-1] + 1
+            self.rows_seen += len(df)
+            enforce_budget()
+
+    def shrink(self):
+        # Halves the budget of this store, thinning what no longer fits
+        self.max_rows = max(self.max_rows // 2, MIN_ROWS)
+        while self.length > self.max_rows:
+            self.thin()
+        if len(self.steps) > self.max_rows:
+            self.allocate(self.max_rows)
+
+    def frame(self):
+        # The stored rows as a DataFrame over the buffers, without copying them
+        import pandas as pd
+        with stores_lock:
+            steps, values, length = self.steps, self.values, self.length
+        if steps is None:
+            return pd.DataFrame(columns=self.columns)
+        return pd.DataFrame(values[:length], index=pd.Index(steps[:length], name=self.index_name),
+                            columns=self.columns, copy=False)
+
+
+def total_bytes():
+    with stores_lock:
+        return sum(store.nbytes() for store in stores)
+
+
+def enforce_budget():
+    # Called with stores_lock held: the largest stores give up half their budget until all fit
+    total = sum(store.nbytes() for store in stores)
+    while total > MONITOR_MEMORY_BUDGET:
+        candidates = [store for store in stores if store.max_rows > MIN_ROWS and store.nbytes()]
+        if not candidates:
+            break
+        largest = max(candidates, key=lambda store: store.nbytes())
+        before = largest.nbytes()
+        largest.shrink()
+        total -= before - largest.nbytes()
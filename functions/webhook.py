@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_WORKERS
+from config import SEND_GLOBAL_RATE, WEBHOOK_STOP_TIMEOUT
+from functions import send_queue
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_user_id(update):
+    # The sender of whatever the update carries; updates without one go to shard 0
+    for name, event in update.items():
+        if name == 'update_id' or not isinstance(event, dict):
+            continue
+        user = event.get('from') or event.get('user')
+        if user:
+            return user['id']
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+    return 0
+
+
+def shard_of(update, shards):
+    return update_user_id(update) % shards
+
+
+def next_update(updates):
+    # None stops the worker, also sent on behalf of a front process that died
+    while True:
+        try:
+            return updates.get(timeout=1)
+        except queue.Empty:
+            parent = multiprocessing.parent_process()
+            if parent is not None and not parent.is_alive():
+                return None
+
+
+async def serve_updates(bot, dispatcher, updates, shard, shards):
+    # A worker owns every user of its shard: their FSM, SSH clients, monitors and jobs
+    loop = asyncio.get_running_loop()
+    send_queue.global_rate = SEND_GLOBAL_RATE / shards
+    dispatcher.workflow_data.update(shard=shard, shards=shards)
+    await dispatcher.emit_startup(bot=bot, **dispatcher.workflow_data)
+    handling = set()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, next_update, updates)
+            if update is None:
+                break
+            task = asyncio.create_task(dispatcher.feed_raw_update(bot, update))
+            handling.add(task)
+            task.add_done_callback(handling.discard)
+        if handling:
+            # Updates taken from the queue are not lost when the worker stops
+            await asyncio.wait(handling, timeout=WEBHOOK_STOP_TIMEOUT)
+    finally:
+        await dispatcher.emit_shutdown(bot=bot, **dispatcher.workflow_data)
+        await bot.session.close()
+
+
+def run_worker(updates, shard, shards):
+    from main import create_bot
+    logging.basicConfig(level=logging.INFO)
+    bot, dispatcher = create_bot()
+    asyncio.run(serve_updates(bot, dispatcher, updates, shard, shards))
+
+
+def start_worker(context, updates, shard, shards):
+    # Not a daemon: workers start render processes of their own
+    process = context.Process(target=run_worker, args=(updates, shard, shards), name=f'bot-worker-{shard}')
+    process.start()
+    return process
+
+
+def create_front_app(bot, shards=WEBHOOK_WORKERS, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    # Receives the webhook and hands every update to the worker process of its user
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(shards)]
+    workers = [None] * shards
+
+    async def receive(request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=401)
+        update = await request.json()
+        shard = shard_of(update, shards)
+        if not workers[shard].is_alive():
+            logging.error(f"Bot worker {shard} exited with code {workers[shard].exitcode}, restarting it")
+            workers[shard] = start_worker(context, queues[shard], shard, shards)
+        queues[shard].put(update)
+        return web.Response()
+
+    async def on_startup(app):
+        for shard in range(shards):
+            workers[shard] = start_worker(context, queues[shard], shard, shards)
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL + path, secret_token=secret or None)
+
+    async def on_shutdown(app):
+        for updates in queues:
+            updates.put(None)
+        for worker in workers:
+            await asyncio.to_thread(worker.join, 30)
+        await bot.session.close()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def create_single_app(bot, dispatcher, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    # One process: aiogram handles the webhook requests itself
+    app = web.Application()
+    SimpleRequestHandler(dispatcher, bot, secret_token=secret or None).register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+
+    async def on_startup(app):
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL + path, secret_token=secret or None)
+
+    app.on_startup.append(on_startup)
+    return app
+
+
+def run_webhook(bot, dispatcher, shards=WEBHOOK_WORKERS):
+    if shards > 1:
+        app = create_front_app(bot, shards)
+    else:
+        app = create_single_app(bot, dispatcher)
+    web.run_app(app, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT)
@@ -1,26 +1,48 @@
 import logging
 
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.dispatcher.router import Router
-
 import asyncio
 
-from functions.handlers import setup_handlers
-from functions.save_load_data import save_connection_details, load_connection_details
+from config import API_TOKEN, BOT_MODE
+
+
+def create_bot(token=API_TOKEN):
+    # Nothing happens at import time: render and webhook worker processes import this
+    # module as __mp_main__ and must not open the store, build a bot or load the handlers
+    from aiogram import Bot, Dispatcher
+    from aiogram.dispatcher.router import Router
+
+    from functions.handlers import setup_handlers
+    from functions.save_load_data import load_connection_details, close_store
+    from functions.rendering import start_warm_up
+    from functions.monitor import resume_monitoring
+    from functions.fsm_storage import create_storage
+    from functions.instrumentation import dispatch_middleware, start_metrics_server, stop_metrics_server
 
-from config import API_TOKEN
+    bot = Bot(token=token)
+    router = Router()
 
-saved_connection_details = load_connection_details()
+    setup_handlers(router, bot, load_connection_details())
 
-logging.basicConfig(level=logging.INFO)
+    dispatcher = Dispatcher(storage=create_storage())
+    dispatcher.include_router(router)
+    dispatcher.update.outer_middleware(dispatch_middleware)
+    dispatcher.startup.register(start_warm_up)
+    dispatcher.startup.register(resume_monitoring)
+    dispatcher.startup.register(start_metrics_server)
+    dispatcher.shutdown.register(close_store)
+    dispatcher.shutdown.register(stop_metrics_server)
+    return bot, dispatcher
 
-bot = Bot(token=API_TOKEN)
-router = Router()
 
-setup_handlers(router)
+def main():
+    from functions.webhook import run_webhook
+    logging.basicConfig(level=logging.INFO)
+    bot, dispatcher = create_bot()
+    if BOT_MODE == 'webhook':
+        run_webhook(bot, dispatcher)
+    else:
+        asyncio.run(dispatcher.start_polling(bot))
 
-dispatcher = Dispatcher()
-dispatcher.include_router(router)
 
 if __name__ == '__main__':
-    asyncio.run(dispatcher.start_polling(bot))
\ No newline at end of file
+    main()
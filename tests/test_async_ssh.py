@@ -0,0 +1,61 @@
+import asyncio
+import time
+import warnings
+
+import pytest
+
+from benchmarks import sshserver
+from functions import async_ssh
+
+HANG_TIMEOUT = 2  # Seconds the hung command is given before run_blocking gives up on it
+
+
+@pytest.fixture(scope='module')
+def port():
+    warnings.filterwarnings('ignore', module='paramiko')
+    return sshserver.serve()
+
+
+def test_hung_connection_does_not_block_other_clients(port):
+    hung, healthy = sshserver.connect(port), sshserver.connect(port)
+
+    async def scenario():
+        hung_call = asyncio.create_task(async_ssh.exec_command(hung, 'sleep 30', timeout=HANG_TIMEOUT))
+        await asyncio.sleep(0.2)
+        start = time.perf_counter()
+        output, error = await async_ssh.exec_command(healthy, 'echo ok')
+        answered = time.perf_counter() - start
+        start = time.perf_counter()
+        with pytest.raises(asyncio.TimeoutError):
+            await hung_call
+        return output, answered, time.perf_counter() - start
+
+    try:
+        output, answered, timed_out = asyncio.run(scenario())
+    finally:
+        hung.close()
+        healthy.close()
+    assert output == 'ok'
+    assert answered < HANG_TIMEOUT / 2
+    assert timed_out < HANG_TIMEOUT + 1
+
+
+def test_event_loop_keeps_running_during_hung_call(port):
+    hung = sshserver.connect(port)
+
+    async def scenario():
+        hung_call = asyncio.create_task(async_ssh.exec_command(hung, 'sleep 30', timeout=HANG_TIMEOUT))
+        ticks = 0
+        while not hung_call.done():
+            await asyncio.sleep(0.1)
+            ticks += 1
+        with pytest.raises(asyncio.TimeoutError):
+            hung_call.result()
+        return ticks
+
+    try:
+        ticks = asyncio.run(scenario())
+    finally:
+        hung.close()
+    # About HANG_TIMEOUT / 0.1 ticks when nothing blocks the loop
+    assert ticks >= HANG_TIMEOUT / 0.1 * 0.5
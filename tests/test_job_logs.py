@@ -0,0 +1,22 @@
+from functions import metrics, plotting
+
+# Slurm job output: metric lines between the banners and stderr of the job
+JOB_OUTPUT = ('SLURM_JOB_ID=123 running on node01\n'
+              'Loading modules "cuda/12.1"\n'
+              'Epoch 1 loss 0.5 accuracy 0.1\n'
+              'Warning: no GPU visible\n'
+              'Epoch 2 loss 0.4 accuracy 0.2\n'
+              'Traceback (most recent call last):\n'
+              'Epoch 3 loss 0.3 accuracy 0.3\n')
+
+
+def test_log_parser_skips_non_metric_lines():
+    df = plotting.parse_log_text(JOB_OUTPUT)
+    assert df.index.tolist() == [1, 2, 3]
+    assert df.columns.tolist() == ['loss', 'accuracy']
+    assert df['loss'].tolist() == [0.5, 0.4, 0.3]
+
+
+def test_schema_skips_non_metric_lines():
+    assert metrics.parse_schema(JOB_OUTPUT, '.out', True) == ['loss', 'accuracy']
+    assert metrics.parse_schema('SLURM_JOB_ID=123 running on node01\nEpoch 1 lo', '.out', False) is None
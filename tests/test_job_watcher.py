@@ -0,0 +1,62 @@
+import asyncio
+
+from functions import job_watcher, send_queue
+
+CLUSTER = ('cluster.example', 22)
+
+
+class FakeTransport:
+    def is_active(self):
+        return True
+
+    def getpeername(self):
+        return CLUSTER
+
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        pass
+
+
+class FakeClient:
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get_transport(self):
+        return self.transport
+
+
+def test_one_query_per_cluster_connection(monkeypatch):
+    shared, other = FakeTransport(), FakeTransport()
+    # Users 1 and 2 share an account and its connection, user 3 has an account of their own
+    clients = {1: FakeClient(shared), 2: FakeClient(shared), 3: FakeClient(other)}
+    jobs = {'101': {'user_id': 1, 'state': None}, '102': {'user_id': 1, 'state': None},
+            '201': {'user_id': 2, 'state': None}, '301': {'user_id': 3, 'state': None}}
+    monkeypatch.setattr(job_watcher, 'tracked_jobs', {CLUSTER: jobs})
+    monkeypatch.setattr(job_watcher, 'cluster_clients', {CLUSTER: dict(clients)})
+    queries, sent = [], []
+
+    async def query_states(ssh_client, job_ids):
+        queries.append((ssh_client.get_transport(), sorted(job_ids)))
+        return {job_id: 'RUNNING' for job_id in job_ids}
+
+    monkeypatch.setattr(job_watcher, 'query_states', query_states)
+    monkeypatch.setattr(send_queue, 'enqueue', lambda user_id, send: sent.append((user_id, send.args[1])))
+    asyncio.run(job_watcher.check_cluster(CLUSTER, FakeBot()))
+
+    assert sorted(queries, key=lambda query: query[1]) == [(shared, ['101', '102', '201']), (other, ['301'])]
+    assert sorted(sent) == [(1, "Задача 101 запущена."), (1, "Задача 102 запущена."),
+                            (2, "Задача 201 запущена."), (3, "Задача 301 запущена.")]
+
+
+def test_job_log_path_rejects_injected_ids(monkeypatch):
+    commands = []
+
+    async def exec_command(ssh_client, command):
+        commands.append(command)
+        return 'JobId=123 StdOut=/scratch/slurm-123.out', ''
+
+    monkeypatch.setattr(job_watcher, 'exec_command', exec_command)
+    assert asyncio.run(job_watcher.job_log_path(None, '123;rm -rf ~')) is None
+    assert asyncio.run(job_watcher.job_log_path(None, '123')) == '/scratch/slurm-123.out'
+    assert commands == ['scontrol show job -o 123']
@@ -0,0 +1,25 @@
+import asyncio
+
+import main
+from functions import instrumentation, rendering
+
+TOKEN = '42:TEST'
+
+
+def test_startup_hooks_run(tmp_path, monkeypatch):
+    # The real dispatcher: every startup hook has to run on the event loop of the bot
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(instrumentation, 'METRICS_PORT', 0)
+    monkeypatch.setattr(rendering, 'warm_up_task', None)
+    bot, dispatcher = main.create_bot(TOKEN)
+
+    async def scenario():
+        await dispatcher.emit_startup(bot=bot)
+        try:
+            assert rendering.warm_up_task is not None and not rendering.warm_up_task.done()
+            rendering.warm_up_task.cancel()
+        finally:
+            await dispatcher.emit_shutdown(bot=bot)
+            await bot.session.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,95 @@
+import asyncio
+import queue
+
+from aiogram import Bot, Dispatcher, Router
+from aiohttp.test_utils import TestClient, TestServer
+
+from functions import webhook
+from functions.webhook import SECRET_HEADER
+
+SHARDS = 3
+SECRET = 'secret'
+PATH = '/webhook'
+
+
+class FakeWorker:
+    # Stands in for a bot worker process; the test reads its queue instead
+    def __init__(self, updates):
+        self.updates = updates
+
+    def is_alive(self):
+        return True
+
+    def join(self, timeout=None):
+        pass
+
+
+def message(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'user'}
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'from': user,
+                                                'chat': {'id': user_id, 'type': 'private'}, 'text': '/status'}}
+
+
+def callback(update_id, user_id):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'user'}
+    return {'update_id': update_id, 'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '1',
+                                                       'data': 'queue_page_0'}}
+
+
+def test_updates_of_a_user_always_reach_the_same_worker(monkeypatch):
+    workers = {}
+
+    def start_worker(context, updates, shard, shards):
+        workers[shard] = FakeWorker(updates)
+        return workers[shard]
+
+    monkeypatch.setattr(webhook, 'start_worker', start_worker)
+    monkeypatch.setattr(webhook, 'WEBHOOK_URL', '')
+    updates = [(message if i % 2 else callback)(i, 1000 + i % 7) for i in range(42)]
+
+    async def scenario():
+        bot = Bot('42:TEST')
+        app = webhook.create_front_app(bot, shards=SHARDS, path=PATH, secret=SECRET)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post(PATH, json=updates[0])
+            assert response.status == 401
+            for update in updates:
+                response = await client.post(PATH, json=update, headers={SECRET_HEADER: SECRET})
+                assert response.status == 200
+            received = {}
+            for shard, worker in workers.items():
+                for _ in range(sum(1 for update in updates if webhook.shard_of(update, SHARDS) == shard)):
+                    received.setdefault(shard, []).append(worker.updates.get(timeout=5))
+        return received
+
+    received = asyncio.run(scenario())
+    assert sorted(workers) == list(range(SHARDS))
+    assert sum(len(shard_updates) for shard_updates in received.values()) == len(updates)
+    shards_of_user = {}
+    for shard, shard_updates in received.items():
+        for update in shard_updates:
+            shards_of_user.setdefault(webhook.update_user_id(update), set()).add(shard)
+        # Each worker sees its users' updates in the order they arrived
+        update_ids = [update['update_id'] for update in shard_updates]
+        assert update_ids == sorted(update_ids)
+    assert len(shards_of_user) == 7
+    assert all(shards == {user_id % SHARDS} for user_id, shards in shards_of_user.items())
+
+
+def test_worker_handles_every_update_before_stopping():
+    handled = []
+    router = Router()
+
+    @router.message()
+    async def record(message):
+        await asyncio.sleep(0.2)
+        handled.append(message.message_id)
+
+    dispatcher = Dispatcher()
+    dispatcher.include_router(router)
+    updates = queue.Queue()
+    for i in range(5):
+        updates.put(message(i, 1000))
+    updates.put(None)
+    asyncio.run(webhook.serve_updates(Bot('42:TEST'), dispatcher, updates, 0, 1))
+    assert sorted(handled) == list(range(5))